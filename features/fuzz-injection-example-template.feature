@@ -65,6 +65,10 @@ Feature: Do fuzz injection testing for an API
     # Timeout after which the requests are canceled so the test won't hang
     And a timeout of "5" seconds
 
+    # How many injection requests may be in flight at the same time.
+    # Leave this out to send the requests one by one.
+    # And at most "10" concurrent requests to the target
+
     # The actual test; this does fuzzing. Start with a small number
     # first and once you know it works, aim to do thousands of injections.
     # Note that this number is multiplied by every key and value in your
@@ -47,6 +47,10 @@ Feature: Do static injection testing for an API
     # Timeout after which the requests are canceled so the test won't hang
     And a timeout of "5" seconds
 
+    # How many injection requests may be in flight at the same time.
+    # Leave this out to send the requests one by one.
+    # And at most "10" concurrent requests to the target
+
     # The actual test; this injects static data. If you want to fuzz,
     # see the other example
     When injecting static bad data for every key and value
@@ -0,0 +1,85 @@
+"""A cache for authentication material.
+
+authenticate() in features/authenticate.py may log in over HTTP each
+time it is called. The cache keeps the Requests auth object for each
+authentication flow id, and only asks authenticate() for new material
+when the cached one has expired, or when the target has responded with
+a status code that indicates an authentication failure. The cache is
+safe to use from several sender threads; concurrent senders that see
+the material expire or fail wait for one refresh instead of each
+logging in.
+
+"""
+import threading
+import time
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+# Status codes that indicate that the auth material is no longer valid
+AUTH_FAILURE_CODES = [401, 403, 419, 440]
+
+
+class AuthCache(object):
+    """Auth objects by authentication flow id, with a time to live"""
+
+    def __init__(self, authenticate, ttl=None):
+        """
+        :param authenticate: The authenticate() function from
+        authenticate.py
+        :param ttl: Seconds after which the material is refreshed, or None
+        to keep it until the target rejects it
+        """
+        self.authenticate = authenticate
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # auth flow id -> (auth object, expiry time)
+        self.stale = set()  # auth flow ids whose material has been rejected
+
+    def get(self, context, auth_id, refresh=False):
+        """Return auth material for an authentication flow, acquiring new
+        material if needed
+
+        :param context: The Behave context
+        :param auth_id: Authentication flow id
+        :param refresh: True to acquire new material in any case
+        :return: A Requests auth object
+        """
+        with self.lock:
+            entry = self.entries.get(auth_id)
+            if entry is not None and refresh is False and \
+                    auth_id not in self.stale and \
+                    (entry[1] is None or entry[1] > time.time()):
+                return entry[0]
+            # Acquire while holding the lock, so that concurrent senders
+            # wait for this login instead of starting their own
+            auth = self.authenticate(context, auth_id,
+                                     acquire_new_authenticator=entry is not None)
+            expiry = None
+            if self.ttl is not None:
+                expiry = time.time() + self.ttl
+            self.entries[auth_id] = (auth, expiry)
+            self.stale.discard(auth_id)
+            return auth
+
+    def invalidate(self, auth_id, auth=None):
+        """Mark the material of an authentication flow as rejected, so that
+        it is refreshed on next use
+
+        :param auth_id: Authentication flow id
+        :param auth: The auth object that was rejected; if the material has
+        already been refreshed since, nothing is done
+        """
+        with self.lock:
+            entry = self.entries.get(auth_id)
+            if entry is not None and (auth is None or entry[0] is auth):
+                self.stale.add(auth_id)
+
+    def check_response(self, auth_id, auth, response):
+        """Invalidate the material if the target rejected it
+
+        :param auth_id: Authentication flow id
+        :param auth: The auth object used for the request
+        :param response: The response dict, see httptools.py
+        """
+        if response.get('resp_statuscode') in AUTH_FAILURE_CODES:
+            self.invalidate(auth_id, auth)
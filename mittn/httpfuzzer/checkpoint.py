@@ -0,0 +1,118 @@
+"""Checkpoints for resuming long injection runs.
+
+A journal file records each injection case of a scenario once its
+response has been analysed and any finding stored. The cases are
+identified by (anomaly index, mutation index, HTTP method). If the run
+is interrupted, the next run of the same scenario skips the cases in
+the journal. For fuzzing, the Radamsa seed is saved next to the
+journal, so that a resumed run generates the same fuzz cases again
+instead of new ones.
+
+The journal starts with a fingerprint of the scenario settings. If the
+settings have changed since the journal was written, the journal is
+discarded and the run starts from the beginning. When a run completes,
+its journal is removed.
+
+"""
+import os
+import re
+import json
+import hashlib
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+
+class InjectionJournal(object):
+    """Progress journal of one scenario"""
+
+    # The journal is synced to disk after this many cases
+    sync_interval = 100
+
+    def __init__(self, directory, scenario_id, fingerprint):
+        """Open the journal, loading the progress of an earlier run
+
+        :param directory: Directory that holds the journals
+        :param scenario_id: Scenario identifier from the feature file
+        :param fingerprint: String that identifies the scenario settings
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        basename = re.sub(r'[^A-Za-z0-9_.-]', '_', str(scenario_id))
+        self.path = os.path.join(directory, basename + '.journal')
+        self.seed_path = os.path.join(directory, basename + '.seed')
+        self.fingerprint = fingerprint
+        self.done = set()
+        resumable = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as journal:
+                if journal.readline().rstrip('\n') == fingerprint:
+                    resumable = True
+                    for line in journal:
+                        try:
+                            self.done.add(tuple(json.loads(line)))
+                        except ValueError:
+                            break  # Partially written last line
+        if not resumable:
+            self.discard()
+        self.journal = open(self.path, 'a')
+        if self.journal.tell() == 0:
+            self.journal.write(fingerprint + '\n')
+        self.unsynced = 0
+
+    def completed(self, key):
+        """:return: True if an earlier run completed the case"""
+        return key in self.done
+
+    def record(self, key):
+        """Record a case as completed
+
+        :param key: (anomaly index, mutation index, method)
+        """
+        self.journal.write(json.dumps(list(key)) + '\n')
+        self.journal.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.sync_interval:
+            os.fsync(self.journal.fileno())
+            self.unsynced = 0
+
+    def save_seed(self, seed):
+        """Save the Radamsa seed of the scenario
+
+        :param seed: Integer seed, see fuzzer.py
+        """
+        temporary_path = self.seed_path + '.tmp'
+        with open(temporary_path, 'w') as seedfile:
+            seedfile.write("%s\n%d\n" % (self.fingerprint, seed))
+        os.rename(temporary_path, self.seed_path)
+
+    def load_seed(self):
+        """:return: The Radamsa seed saved by an earlier run, or None"""
+        if not os.path.exists(self.seed_path):
+            return None
+        with open(self.seed_path, 'r') as seedfile:
+            lines = seedfile.read().split()
+        if len(lines) != 2 or lines[0] != self.fingerprint:
+            return None
+        return int(lines[1])
+
+    def complete(self):
+        """The run has completed; remove the journal and the seed"""
+        self.journal.close()
+        self.discard()
+
+    def discard(self):
+        for path in (self.path, self.seed_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def scenario_fingerprint(context, *settings):
+    """Return a fingerprint of the settings that define the injection
+    space of the scenario
+
+    :param context: The Behave context
+    :param settings: Any additional settings, such as the fuzz case count
+    """
+    values = [context.targeturi, context.type, context.submission,
+              getattr(context, 'injection_methods', None)] + list(settings)
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
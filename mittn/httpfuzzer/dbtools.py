@@ -1,8 +1,14 @@
 """Helper functions for managing the false positives database."""
 import os
 import socket  # For getting hostname where we're running on
+import datetime
+import threading
+import time
+import atexit
+import logging
 from sqlalchemy import create_engine, Table, Column, MetaData, exc, types
-from sqlalchemy import sql, and_
+from sqlalchemy import sql, inspect, func, Index
+import hashlib
 
 __copyright__ = "Copyright (c) 2013- F-Secure"
 
@@ -14,47 +20,451 @@ def open_database(context):
     :param context: The Behave context
     :return: A database handle, or None if no database in use
     """
+    store = finding_store(context)
+    if store is None:
+        return None  # No false positives database is in use
+    return store.connect()
+
+
+# Finding stores by database URL, shared by all the scenarios of the run
+finding_stores = {}
+finding_stores_lock = threading.Lock()
+
+
+def finding_store(context):
+    """Return the finding store of the database specified in the feature
+    file, creating it on first use
+
+    :param context: The Behave context
+    :return: A FindingStore, or None if no database in use
+    """
     if hasattr(context, 'dburl') is False:
         return None  # No false positives database is in use
-    dbconn = None
-
-    # Try to connect to the database
-    try:
-        db_engine = create_engine(context.dburl)
-        dbconn = db_engine.connect()
-    except (IOError, exc.OperationalError):
-        assert False, "Cannot connect to database '%s'" % context.dburl
-
-    # Set up the database table to store new findings and false positives.
-    # We use LargeBinary to store those fields that could contain somehow
-    # bad Unicode, just in case some component downstream tries to parse
-    # a string provided as Unicode.
-    db_metadata = MetaData()
-    db_metadata.bind = db_engine
-    context.httpfuzzer_issues = Table('httpfuzzer_issues', db_metadata,
-                                      Column('new_issue', types.Boolean),
-                                      Column('issue_no', types.Integer, primary_key=True, nullable=False),
-                                      Column('timestamp', types.DateTime(timezone=True)),
-                                      Column('test_runner_host', types.Text),
-                                      Column('scenario_id', types.Text),
-                                      Column('url', types.Text),
-                                      Column('server_protocol_error', types.Text),
-                                      Column('server_timeout', types.Boolean),
-                                      Column('server_error_text_detected', types.Boolean),
-                                      Column('server_error_text_matched', types.Text),
-                                      Column('req_method', types.Text),
-                                      Column('req_headers', types.LargeBinary),
-                                      Column('req_body', types.LargeBinary),
-                                      Column('resp_statuscode', types.Text),
-                                      Column('resp_headers', types.LargeBinary),
-                                      Column('resp_body', types.LargeBinary),
-                                      Column('resp_history', types.LargeBinary))
-
-    # Create the table if it doesn't exist
-    # and otherwise no effect
-    db_metadata.create_all(db_engine)
-
-    return dbconn
+    with finding_stores_lock:
+        store = finding_stores.get(context.dburl)
+        if store is None:
+            store = finding_stores[context.dburl] = FindingStore(
+                context.dburl)
+    context.httpfuzzer_issues = store.table
+    return store
+
+
+class FindingStore(object):
+    """The findings database of a test run. The engine, and with it the
+    pool of database connections, is created once, and the table is
+    created or upgraded once. Connections taken with connect() go back
+    to the pool when they are closed.
+
+    New findings are written right away, in batches, or by a writer
+    thread in the background.
+    """
+
+    # How many findings may wait for the writer thread
+    max_queue = 1000
+
+    def __init__(self, dburl):
+        """
+        :param dburl: SQLAlchemy database URL
+        """
+        self.dburl = dburl
+        # Try to connect to the database
+        try:
+            self.engine = create_engine(dburl)
+            dbconn = self.engine.connect()
+        except (IOError, exc.OperationalError):
+            assert False, "Cannot connect to database '%s'" % dburl
+        dbconn.close()
+
+        # Set up the database table to store new findings and false positives.
+        # We use LargeBinary to store those fields that could contain somehow
+        # bad Unicode, just in case some component downstream tries to parse
+        # a string provided as Unicode.
+        db_metadata = MetaData()
+        db_metadata.bind = self.engine
+        self.table = Table('httpfuzzer_issues', db_metadata,
+                           Column('new_issue', types.Boolean),
+                           Column('issue_no', types.Integer, primary_key=True, nullable=False),
+                           Column('timestamp', types.DateTime(timezone=True)),
+                           Column('test_runner_host', types.Text),
+                           Column('scenario_id', types.Text),
+                           Column('url', types.Text),
+                           Column('server_protocol_error', types.Text),
+                           Column('server_timeout', types.Boolean),
+                           Column('server_error_text_detected', types.Boolean),
+                           Column('server_error_text_matched', types.Text),
+                           Column('req_method', types.Text),
+                           Column('req_headers', types.LargeBinary),
+                           Column('req_body', types.LargeBinary),
+                           Column('resp_statuscode', types.Text),
+                           Column('resp_headers', types.LargeBinary),
+                           Column('resp_body', types.LargeBinary),
+                           Column('resp_history', types.LargeBinary),
+                           Column('min_req_body', types.LargeBinary),
+                           Column('replay_status', types.Text),
+                           Column('replay_timestamp', types.DateTime(timezone=True)),
+                           Column('finding_signature', types.String(40)))
+        # Known findings are looked up by their signature
+        Index('ix_httpfuzzer_issues_finding_signature',
+              self.table.c.finding_signature)
+
+        # Create the table if it doesn't exist
+        # and otherwise no effect
+        db_metadata.create_all(self.engine)
+        upgrade_table(self.engine, self.table)
+        self.backfill_signatures()
+
+        self.lock = threading.Condition()
+        self.pending = []  # Findings not yet written
+        self.pending_since = None  # When the oldest of them was added
+        self.signatures = None  # Signatures of known findings, once loaded
+        # Write-behind state, see write_behind()
+        self.writer = None
+        self.writing = []  # Findings that the writer thread is writing
+        self.write_error = None
+        self.flush_requests = 0
+        self.batch_size = 1
+        self.batch_seconds = None
+        self.timer = None  # Writes a batch that has waited long enough
+
+    def connect(self):
+        """:return: A database connection from the pool"""
+        try:
+            return self.engine.connect()
+        except (IOError, exc.OperationalError):
+            assert False, "Cannot connect to database '%s'" % self.dburl
+
+    def backfill_signatures(self):
+        """Compute the signatures of findings that were stored by an
+        earlier version, or added into the database by hand
+        """
+        columns = self.table.c
+        dbconn = self.connect()
+        try:
+            db_result = dbconn.execute(sql.select(
+                [columns.issue_no, columns.scenario_id,
+                 columns.server_protocol_error, columns.resp_statuscode,
+                 columns.server_timeout,
+                 columns.server_error_text_detected]).where(
+                columns.finding_signature.is_(None)))
+            rows = db_result.fetchall()
+            db_result.close()
+            if rows:
+                with dbconn.begin():
+                    for row in rows:
+                        dbconn.execute(self.table.update().where(
+                            columns.issue_no == row.issue_no).values(
+                            finding_signature=signature_of(row)))
+        finally:
+            dbconn.close()
+
+    def load_signatures(self):
+        """Load the signatures of all the known findings into memory, so
+        that known findings can be recognised without database queries.
+        There are few distinct signatures even in a large database, as
+        they only depend on the scenario and the kind of the failure.
+        """
+        dbconn = self.connect()
+        try:
+            db_result = dbconn.execute(
+                sql.select([self.table.c.finding_signature]).distinct())
+            signatures = set(row[0] for row in db_result)
+            db_result.close()
+        finally:
+            dbconn.close()
+        with self.lock:
+            signatures.update(row['finding_signature'] for row in self.pending)
+            self.signatures = signatures
+
+    def add(self, row, batch_size=1, batch_seconds=None, background=False):
+        """Add a finding. The findings are written in batches, when the
+        batch is full or old enough; a batch size of 1 writes each finding
+        right away.
+
+        :param row: Column values of the finding
+        :param batch_size: How many findings to write at a time
+        :param batch_seconds: Write the batch when its oldest finding has
+        waited this long, or None to only write full batches
+        :param background: True to hand the finding over to a writer
+        thread instead of writing it here. If the writer has fallen
+        max_queue findings behind, this waits until it catches up.
+        """
+        with self.lock:
+            if background:
+                self.batch_size = batch_size
+                self.batch_seconds = batch_seconds
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self.write_behind)
+                    self.writer.daemon = True
+                    self.writer.start()
+                while len(self.pending) >= self.max_queue:
+                    self.lock.wait()
+            self.pending.append(row)
+            if self.signatures is not None:
+                self.signatures.add(row['finding_signature'])
+            if self.pending_since is None:
+                self.pending_since = time.time()
+            if background:
+                self.lock.notify_all()
+                return
+            due = len(self.pending) >= batch_size or (
+                batch_seconds is not None and
+                time.time() - self.pending_since >= batch_seconds)
+            if not due and batch_seconds is not None and self.timer is None:
+                self.start_timer(batch_seconds)
+        if due:
+            self.flush()
+
+    def start_timer(self, batch_seconds):
+        """Write the pending findings when the oldest of them has waited
+        for batch_seconds, even if no more findings are added. Called
+        with the lock held.
+        """
+        delay = max(0, self.pending_since + batch_seconds - time.time())
+        self.timer = threading.Timer(delay, self.flush_expired,
+                                     (batch_seconds,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush_expired(self, batch_seconds):
+        """Timer callback: write the pending findings if the oldest of them
+        has waited for batch_seconds. An error is reported by the next
+        flush().
+        """
+        with self.lock:
+            self.timer = None
+            if not self.pending:
+                return  # Already written
+            if time.time() - self.pending_since < batch_seconds:
+                self.start_timer(batch_seconds)  # A newer batch
+                return
+            try:
+                self.flush()
+            except Exception as error:  # Reported by flush()
+                self.write_error = error
+
+    def flush(self):
+        """Write the pending findings in one transaction. With a writer
+        thread, wait until it has written everything that was added
+        before this call.
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.flush_requests += 1
+                self.lock.notify_all()
+                try:
+                    while self.pending or self.writing:
+                        self.lock.wait()
+                finally:
+                    self.flush_requests -= 1
+                error, self.write_error = self.write_error, None
+                if error is not None:
+                    raise error
+                return
+            rows = self.pending
+            # A batch that fails to be written is reported to the caller,
+            # and not retried
+            self.pending = []
+            self.pending_since = None
+            if len(rows) > 0:
+                dbconn = self.connect()
+                try:
+                    self.write(dbconn, rows)
+                finally:
+                    dbconn.close()
+            error, self.write_error = self.write_error, None
+            if error is not None:
+                raise error
+
+    def has_pending(self):
+        """:return: True if some findings have not been written yet"""
+        with self.lock:
+            return len(self.pending) > 0 or len(self.writing) > 0
+
+    def write(self, dbconn, rows):
+        """Insert findings in one transaction. If that fails, the
+        findings are logged, as they are not retried.
+        """
+        try:
+            with dbconn.begin():
+                if self.engine.dialect.supports_multivalues_insert:
+                    # Multi-row INSERTs, kept under the common limit
+                    # of 999 bound parameters per statement
+                    step = max(1, 999 // len(self.table.columns))
+                    for start in range(0, len(rows), step):
+                        dbconn.execute(self.table.insert().values(
+                            rows[start:start + step]))
+                else:
+                    dbconn.execute(self.table.insert(), rows)
+        except Exception as error:
+            logger = logging.getLogger(__name__)
+            logger.error("Could not store %d findings: %s", len(rows), error)
+            for row in rows:
+                logger.error("Lost finding: scenario %s, %s %s, status %s, "
+                             "signature %s", row['scenario_id'],
+                             row['req_method'], row['url'],
+                             row['resp_statuscode'], row['finding_signature'])
+            raise
+
+    def write_behind(self):
+        """The writer thread: write the findings in batches as they come
+        in, on a connection of its own. An error is reported by the next
+        flush().
+        """
+        dbconn = None
+        while True:
+            with self.lock:
+                while not self.batch_due():
+                    self.lock.wait(self.wait_time())
+                self.writing = self.pending
+                self.pending = []
+                self.pending_since = None
+                self.lock.notify_all()  # There is room in the queue again
+            try:
+                if dbconn is None:
+                    dbconn = self.engine.connect()
+                self.write(dbconn, self.writing)
+            except Exception as error:  # Reported by flush()
+                self.write_error = error
+                if dbconn is not None:
+                    dbconn.close()
+                    dbconn = None
+            with self.lock:
+                self.writing = []
+                self.lock.notify_all()
+
+    def batch_due(self):
+        """:return: True if the writer thread should write the pending
+        findings now. Called with the lock held.
+        """
+        if not self.pending:
+            return False
+        # A full queue is written even if the batch is larger, so that
+        # add() does not wait for the batch forever
+        return self.flush_requests > 0 or \
+            len(self.pending) >= min(self.batch_size, self.max_queue) or \
+            (self.batch_seconds is not None and
+             time.time() - self.pending_since >= self.batch_seconds)
+
+    def wait_time(self):
+        """:return: How long the writer thread may sleep"""
+        if self.pending and self.batch_seconds is not None:
+            return max(0.01, self.pending_since + self.batch_seconds -
+                       time.time())
+        return 1.0
+
+    def known_in_memory(self, signature):
+        """:return: True or False if the signatures have been loaded,
+        None if they have not
+        """
+        with self.lock:
+            if self.signatures is None:
+                return None
+            return signature in self.signatures
+
+    def pending_match(self, response):
+        """:return: True if a finding that has not been written yet would
+        make the response a known issue, see known_false_positive()
+        """
+        signature = signature_of(response)
+        with self.lock:
+            for row in self.pending + self.writing:
+                if row['finding_signature'] == signature:
+                    return True
+        return False
+
+
+# The fields that identify a finding
+SIGNATURE_FIELDS = ['scenario_id', 'server_protocol_error', 'resp_statuscode',
+                    'server_timeout', 'server_error_text_detected']
+
+
+def signature_of(finding):
+    """Return the signature of a finding: a hash of the values that
+    identify it, see known_false_positive()
+
+    :param finding: A response dict, or a database row
+    :return: The signature as a hex string
+    """
+    if isinstance(finding, dict):
+        values = [finding[name] for name in SIGNATURE_FIELDS]
+    else:
+        values = [getattr(finding, name) for name in SIGNATURE_FIELDS]
+    scenario_id, protocol_error, statuscode, timeout, error_text = values
+    if protocol_error is not None:
+        protocol_error = str(protocol_error)
+    signature = repr([str(scenario_id), protocol_error, str(statuscode),
+                      bool(timeout), bool(error_text)])
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+
+def flush_all_findings():
+    """Write the findings still being batched in all the stores"""
+    for store in list(finding_stores.values()):
+        store.flush()
+
+atexit.register(flush_all_findings)
+
+
+def upgrade_table(db_engine, table):
+    """Add the columns that a table created by an earlier version lacks.
+    The new columns are all nullable, so existing rows stay valid.
+
+    :param db_engine: SQLAlchemy engine
+    :param table: The Table as this version defines it
+    """
+    existing = set(column['name'] for column in
+                   inspect(db_engine).get_columns(table.name))
+    for column in table.columns:
+        if column.name not in existing:
+            db_engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                table.name, column.name,
+                column.type.compile(dialect=db_engine.dialect)))
+    existing = set(index['name'] for index in
+                   inspect(db_engine).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(db_engine)
+
+
+def stored_findings(context, scenario_id=None):
+    """Return the findings in the database
+
+    :param context: The Behave context
+    :param scenario_id: Only return the findings of this scenario, or None
+    for all
+    :return: A list of database rows
+    """
+    flush_findings(context)
+    dbconn = open_database(context)
+    if dbconn is None:
+        return []
+    db_select = sql.select([context.httpfuzzer_issues])
+    if scenario_id is not None:
+        db_select = db_select.where(
+            context.httpfuzzer_issues.c.scenario_id == str(scenario_id))
+    db_result = dbconn.execute(db_select)
+    findings = db_result.fetchall()
+    db_result.close()
+    dbconn.close()
+    return findings
+
+
+def mark_replayed(context, issue_no, status):
+    """Record the result of replaying a finding
+
+    :param context: The Behave context
+    :param issue_no: The issue_no of the finding
+    :param status: 'reproduces' or 'fixed'
+    """
+    dbconn = open_database(context)
+    if dbconn is None:
+        return
+    db_update = context.httpfuzzer_issues.update().where(
+        context.httpfuzzer_issues.c.issue_no == issue_no).values(
+        replay_status=status,  # Text
+        replay_timestamp=datetime.datetime.utcnow())  # DateTime
+    dbconn.execute(db_update)
+    dbconn.close()
 
 
 def known_false_positive(context, response):
@@ -74,10 +484,16 @@ def known_false_positive(context, response):
     if 'server_error_text_matched' not in response:
         response['server_error_text_matched'] = ''
 
-    dbconn = open_database(context)
-    if dbconn is None:
+    store = finding_store(context)
+    if store is None:
         # No false positive db is in use, all findings are treated as new
         return False
+    known = store.known_in_memory(signature_of(response))
+    if known is not None:
+        return known  # The known signatures were loaded at scenario start
+    if store.pending_match(response):
+        return True  # Known from a finding that is still being batched
+    dbconn = store.connect()
 
     # Check whether we already know about this. A finding is a duplicate if:
     # - It has the same protocol level error message (or None) from Requests AND
@@ -93,24 +509,17 @@ def known_false_positive(context, response):
     # field triggers an issue, you should thoroughly fuzz-test that field
     # separately.
 
-    db_select = sql.select([context.httpfuzzer_issues]).where(
-        and_(
-            context.httpfuzzer_issues.c.scenario_id == response['scenario_id'],  # Text
-            context.httpfuzzer_issues.c.server_protocol_error == response['server_protocol_error'],  # Text
-            context.httpfuzzer_issues.c.resp_statuscode == str(response['resp_statuscode']),  # Text
-            context.httpfuzzer_issues.c.server_timeout == response['server_timeout'],  # Bool
-            context.httpfuzzer_issues.c.server_error_text_detected == response['server_error_text_detected']))  # Bool
+    # These are combined into an indexed signature column, so the check
+    # is a single index lookup.
 
-    db_result = dbconn.execute(db_select)
+    db_select = sql.select([sql.exists().where(
+        context.httpfuzzer_issues.c.finding_signature == signature_of(response))])
 
-    # If none found with these criteria, we did not know about this
-
-    if len(db_result.fetchall()) == 0:
-        return False  # No, we did not know about this
-
-    db_result.close()
+    known = bool(dbconn.execute(db_select).scalar())
     dbconn.close()
-    return True
+
+    # If none found with these criteria, we did not know about this
+    return known
 
 
 def add_false_positive(context, response):
@@ -128,8 +537,8 @@ def add_false_positive(context, response):
     if 'server_error_text_matched' not in response:
         response['server_error_text_matched'] = ''
 
-    dbconn = open_database(context)
-    if dbconn is None:
+    store = finding_store(context)
+    if store is None:
         # There is no false positive db in use, and we cannot store the data,
         # so we will assert a failure. Long assert messages seem to fail,
         # so we truncate uri and submission to 200 bytes.
@@ -150,15 +559,17 @@ def add_false_positive(context, response):
                           response['req_method'],
                           truncated_submission)
 
-    # Add the finding into the database
+    # Add the finding into the database, or into the batch being collected
 
-    db_insert = context.httpfuzzer_issues.insert().values(
+    store.add(dict(
         new_issue=True,  # Boolean
         timestamp=response['timestamp'],  # DateTime
         test_runner_host=socket.gethostbyname(socket.getfqdn()),  # Text
         scenario_id=str(response['scenario_id']),  # Text
         req_headers=str(response['req_headers']),  # Blob
         req_body=str(response['req_body']),  # Blob
+        min_req_body=str(response['min_req_body']) if response.get(
+            'min_req_body') is not None else None,  # Blob
         url=str(response['url']),  # Text
         req_method=str(response['req_method']),  # Text
         server_protocol_error=response['server_protocol_error'],  # Text
@@ -168,23 +579,54 @@ def add_false_positive(context, response):
         resp_statuscode=str(response['resp_statuscode']),  # Text
         resp_headers=str(response['resp_headers']),  # Blob
         resp_body=str(response['resp_body']),  # Blob
-        resp_history=str(response['resp_history']))  # Blob
+        resp_history=str(response['resp_history']),  # Blob
+        finding_signature=signature_of(response)),  # Text
+        batch_size=getattr(context, 'finding_batch_size', 1),
+        batch_seconds=getattr(context, 'finding_batch_seconds', None),
+        background=getattr(context, 'background_finding_writes', False))
 
-    dbconn.execute(db_insert)
-    dbconn.close()
+
+def load_known_findings(context):
+    """Load the signatures of the known findings into memory at the start
+    of a scenario, see FindingStore.load_signatures()
+
+    :param context: The Behave context
+    """
+    store = finding_store(context)
+    if store is not None:
+        store.load_signatures()
+
+
+def flush_findings(context):
+    """Write the findings that are still being batched into the database
+
+    :param context: The Behave context
+    """
+    store = finding_store(context)
+    if store is not None:
+        store.flush()
+
+
+def findings_pending(context):
+    """:return: True if some findings are still being batched
+
+    :param context: The Behave context
+    """
+    store = finding_store(context)
+    return store is not None and store.has_pending()
 
 
 def number_of_new_in_database(context):
+    flush_findings(context)
     dbconn = open_database(context)
     if dbconn is None:  # No database in use
         return 0
 
     true_value = True  # SQLAlchemy cannot have "is True" in where clause
 
-    db_select = sql.select([context.httpfuzzer_issues]).where(
+    db_select = sql.select([func.count()]).select_from(
+        context.httpfuzzer_issues).where(
         context.httpfuzzer_issues.c.new_issue == true_value)
-    db_result = dbconn.execute(db_select)
-    findings = len(db_result.fetchall())
-    db_result.close()
+    findings = dbconn.execute(db_select).scalar()
     dbconn.close()
     return findings
@@ -0,0 +1,164 @@
+"""Detectors that flag suspect server responses, and functions to store
+the flagged responses into the findings database.
+
+A detector is a function that takes a response dict (see httptools.py)
+and returns True if the response indicates a problem. The detectors
+are set up as rules of a classifier by the "storing any new ..."
+steps, and the responses are then checked against all of them in a
+single pass. A response that any rule flags is looked up and stored
+once, with one combined verdict. With streaming response analysis, the
+responses are analysed one at a time as they come in from the
+injector, and only the flagged responses are kept.
+
+"""
+import mittn.httpfuzzer.dbtools as fuzzdb
+from mittn.httpfuzzer.matcher import MultiPatternMatcher
+from mittn.httpfuzzer.minimizer import FindingMinimizer
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+
+def returncode_detector(disallowed_returncodes):
+    """Flag responses with suspect return codes
+
+    :param disallowed_returncodes: List of return codes to flag
+    """
+    def detect(response):
+        return response['resp_statuscode'] in disallowed_returncodes
+    return detect
+
+
+def timeout_detector():
+    """Flag responses that timed out"""
+    def detect(response):
+        return response.get('server_timeout') is True
+    return detect
+
+
+def protocol_error_detector():
+    """Flag responses with HTTP protocol errors (as caught by Requests)"""
+    def detect(response):
+        return response.get('server_protocol_error') is not None
+    return detect
+
+
+def body_string_detector(error_list, limit=None):
+    """Flag responses whose body contains any of a list of strings
+
+    :param error_list: List of strings that indicate an error
+    :param limit: Scan at most this many bytes of each body, or None
+    """
+    # Compile the error response list once for all the responses
+    matcher = MultiPatternMatcher(error_list)
+
+    def detect(response):
+        matched = matcher.search(response.get('resp_body'), limit)
+        if matched is not None:
+            response['server_error_text_detected'] = True
+            response['server_error_text_matched'] = matched
+            return True
+        return False
+    return detect
+
+
+class ResponseClassifier(object):
+    """Checks responses against all the detectors of a scenario in one
+    pass. The detectors are added as named rules by the "storing any new
+    ..." steps.
+    """
+
+    def __init__(self):
+        self.rules = []  # List of (name, detector function)
+
+    def add_rule(self, name, detector):
+        """Add a detector to the rules
+
+        :param name: Name of the rule, reported in the verdicts
+        :param detector: A detector function
+        """
+        self.rules.append((name, detector))
+
+    def classify(self, response):
+        """Check a response against every rule
+
+        :param response: A response dict, see httptools.py
+        :return: The combined verdict: a list of names of the rules that
+        flagged the response, empty if the response is fine
+        """
+        verdict = []
+        for name, detector in self.rules:
+            if detector(response) is True:
+                verdict.append(name)
+        return verdict
+
+
+def add_detector(context, name, detector):
+    """Take a detector into use in the current scenario. The responses
+    are checked by analyse_responses() once all the detectors are known.
+
+    :param context: The Behave context
+    :param name: Name of the detector rule
+    :param detector: A detector function
+    """
+    if getattr(context, 'response_classifier', None) is None:
+        context.response_classifier = ResponseClassifier()
+    context.response_classifier.add_rule(name, detector)
+
+
+def analyse_responses(context):
+    """Run the responses of the scenario through the classifier in a
+    single pass, and store each flagged response that is not a known
+    issue as a new finding. With streaming analysis, the responses come
+    in one at a time from the injector, and only the flagged responses
+    are kept in context.responses.
+
+    :param context: The Behave context
+    """
+    responses = getattr(context, 'unanalysed_responses', None)
+    if responses is None:
+        return  # Nothing injected, or already analysed
+    context.unanalysed_responses = None
+    if getattr(context, 'response_classifier', None) is None:
+        context.response_classifier = ResponseClassifier()  # Flags nothing
+    streaming = getattr(context, 'streaming_analysis', False) is True
+    journal = getattr(context, 'journal', None)
+    unjournaled = []  # Cases whose findings may still be batched
+    new_findings = 0
+    for response in responses:
+        verdict = context.response_classifier.classify(response)
+        if verdict:
+            response['verdict'] = verdict
+            new_findings += store_finding(context, response)
+            if streaming:
+                context.responses.append(response)
+        if journal is not None:
+            # A case is journaled only once its finding has been written,
+            # so that a crash cannot lose a finding of a journaled case
+            unjournaled.append(response['case_key'])
+            if not fuzzdb.findings_pending(context):
+                for key in unjournaled:
+                    journal.record(key)
+                unjournaled = []
+    fuzzdb.flush_findings(context)
+    if journal is not None:
+        journal.complete()
+    if new_findings > 0:
+        context.new_findings += new_findings
+
+
+def store_finding(context, response):
+    """Store a flagged response into the database, unless it is a known
+    issue. New findings are minimised first if that has been requested.
+
+    :param context: The Behave context
+    :param response: A flagged response dict
+    :return: 1 if the finding was new, otherwise 0
+    """
+    if fuzzdb.known_false_positive(context, response) is False:
+        if getattr(context, 'minimize_findings', None) is not None and \
+                response.get('mutation') is not None:
+            response['min_req_body'] = FindingMinimizer(
+                context, response, context.minimize_findings).minimize()
+        fuzzdb.add_false_positive(context, response)
+        return 1
+    return 0
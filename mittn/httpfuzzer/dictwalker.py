@@ -15,9 +15,15 @@ valid samples for each key separately.
 
 """
 import copy
+import collections
 
 __copyright__ = "Copyright (c) 2013- F-Secure"
 
+try:
+    text_types = (str, unicode)
+except NameError:  # Python 3
+    text_types = (str,)
+
 
 def anomaly_dict_generator_static(static_anomalies_list):
     """Return a dict with a key None and one single anomaly from static
@@ -56,48 +62,64 @@ def dictwalk(branch, anomaly_dict, anomaly_key=None):
     taken from a dict of anomalies. The dict has a "generic" anomaly with
     a key of None, and may have specific anomalies under other keys.
 
+    This builds every mutated data structure up front; the injector uses
+    iter_mutations() and apply_mutation() to build them one at a time.
+
+    :param branch: The branch of a data structure to walk into.
+    :param anomaly_dict: One of the anomaly dictionaries that has been prepared
+    :param anomaly_key: If the branch where we walk into is under a specific
+    key, this is under what key it is
+    """
+    return [apply_mutation(branch, mutation) for mutation in
+            iter_mutations(branch, anomaly_dict, anomaly_key)]
+
+
+# A mutation of a data structure. path is a tuple of the keys and list
+# indexes that lead to the mutated item. If rename is False, the item is
+# replaced with value; if it is True, the key of the item is replaced
+# with value.
+Mutation = collections.namedtuple('Mutation', ['path', 'value', 'rename'])
+
+
+def iter_mutations(branch, anomaly_dict, anomaly_key=None, path=()):
+    """Walk through a data structure recursively, and yield a description
+    of each mutation that dictwalk() would make, in the same order. The
+    data structure itself is not copied.
+
     :param branch: The branch of a data structure to walk into.
     :param anomaly_dict: One of the anomaly dictionaries that has been prepared
     :param anomaly_key: If the branch where we walk into is under a specific
     key, this is under what key it is
+    :param path: The path to the branch from the root of the data structure
+    :return: Mutation tuples
     """
     # Process dict-type branches
     if isinstance(branch, dict):
-        fuzzed_branch = []
-        # Add cases where one of the keys has been removed
+        # Add cases where one of the keys has been replaced with an anomaly
+        try:  # Keys need to be strings
+            anomalous_key = str(anomaly_dict[None])
+        except UnicodeEncodeError:  # Key was too broken to be a string
+            anomalous_key = '\xff\xff'  # Revenge using key 0xFFFF
         for key in branch.keys():
-            # Add a case where key has been replaced with an anomaly
-            fuzzdict = branch.copy()
-            try:  # Keys need to be strings
-                fuzzdict[str(anomaly_dict[None])] = fuzzdict[key]
-            except UnicodeEncodeError:  # Key was too broken to be a string
-                fuzzdict['\xff\xff'] = fuzzdict[key]  # Revenge using key 0xFFFF
-            del fuzzdict[key]
-            fuzzed_branch.append(fuzzdict)
+            yield Mutation(path + (key,), anomalous_key, True)
 
+        # Last, add cases where the key's value (branch or leaf)
+        # has been replaced with its fuzzed version
         for key, value in branch.items():
-            # Last, add a case where the key's value (branch or leaf)
-            # has been replaced with its fuzzed version
-            sub_branches = dictwalk(value, anomaly_dict, key)
-            for sub_branch in sub_branches:
-                fuzzdict = branch.copy()
-                fuzzdict[key] = sub_branch
-                fuzzed_branch.append(fuzzdict)
-        return fuzzed_branch
+            for mutation in iter_mutations(value, anomaly_dict, key,
+                                           path + (key,)):
+                yield mutation
+        return
     # Process list-type branches
     if isinstance(branch, list):
-        fuzzed_branch = []
         # Replace each list item (branch or leaf) with its fuzzed version
         for i in range(0, len(branch)):
-            # Add a version where a list item has been fuzzed
-            sub_branches = dictwalk(branch[i], anomaly_dict, anomaly_key)
-            for sub_branch in sub_branches:
-                fuzzdict = copy.copy(branch)
-                fuzzdict[i] = sub_branch
-                fuzzed_branch.append(fuzzdict)
-        return fuzzed_branch
-    # A leaf node; return just a list of anomalies for a value
-    if isinstance(branch, (int, str, unicode, float)) or \
+            for mutation in iter_mutations(branch[i], anomaly_dict,
+                                           anomaly_key, path + (i,)):
+                yield mutation
+        return
+    # A leaf node; the value is replaced with an anomaly
+    if isinstance(branch, (int, float) + text_types) or \
             branch in (True, False, None):
         # Get the anomaly to be injected from the anomaly_dict.
         anomaly = anomaly_dict.get(anomaly_key)
@@ -105,8 +127,34 @@ def dictwalk(branch, anomaly_dict, anomaly_key=None):
             # There is no specific anomaly for this key's values, so we use a
             #  generic one
             anomaly = anomaly_dict.get(None)
-        return [anomaly]
+        yield Mutation(path, anomaly, False)
+        return
     # Finally, the data structure contains something that a unserialised JSON
     # cannot contain; instead of just removing it, we return it as-is without
     # injection
-    return [branch]
+    yield Mutation(path, branch, False)
+
+
+def apply_mutation(document, mutation):
+    """Build a mutated data structure. Only the dicts and lists on the
+    path to the mutated item are copied; the rest of the new data
+    structure is shared with the original.
+
+    :param document: The original data structure
+    :param mutation: A Mutation from iter_mutations()
+    :return: The mutated data structure
+    """
+    if mutation.path == ():
+        return mutation.value
+    if isinstance(document, dict):
+        mutated = document.copy()
+    else:
+        mutated = copy.copy(document)
+    step = mutation.path[0]
+    if len(mutation.path) == 1 and mutation.rename is True:
+        mutated[mutation.value] = mutated[step]
+        del mutated[step]
+    else:
+        mutated[step] = apply_mutation(
+            document[step], mutation._replace(path=mutation.path[1:]))
+    return mutated
@@ -6,6 +6,11 @@ import tempfile
 import os
 import subprocess
 import shutil
+import hashlib
+import struct
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 __copyright__ = "Copyright (c) 2013- F-Secure"
 
@@ -40,62 +45,285 @@ def collect_values(branch, valid_values, anomaly_key=None):
     return valid_values
 
 
-def fuzz_values(valuedict, no_of_fuzzcases, radamsacmd):
+def fuzz_values(valuedict, no_of_fuzzcases, radamsacmd, seed=None,
+                processes=None, cache=None):
     """Run every key's valid value list through a fuzzer
 
     :param valuedict: Dict of collected valid values
     :param no_of_fuzzcases: How many injection cases to produce
     :param radamsacmd: Command to run Radamsa
+    :param seed: Random seed for Radamsa, or None for a random run. With
+    a seed, the same valid values always produce the same fuzz cases.
+    :param processes: How many Radamsa processes to run at a time, by
+    default one per CPU
+    :param cache: A FuzzCache for reusing the fuzz cases of earlier runs.
+    Only seeded runs are cached, as an unseeded run is expected to
+    produce new cases each time.
     """
-    fuzzdict = {}  # Will hold the result
-    for key in valuedict.keys():
-        # If no values for a key, use the samples under the None key
-        if valuedict[key] == []:
-            fuzzdict[key] = get_fuzz(valuedict[None], no_of_fuzzcases,
-                                     radamsacmd)
-        else:  # Use the samples collected for the specific key
-            fuzzdict[key] = get_fuzz(valuedict[key], no_of_fuzzcases,
-                                     radamsacmd)
+    fuzzdict = dict((key, []) for key in valuedict.keys())  # The result
+    for fuzzcase in iter_fuzz_values(valuedict, no_of_fuzzcases, radamsacmd,
+                                     seed, processes, cache,
+                                     chunk_size=int(no_of_fuzzcases)):
+        for key, value in fuzzcase.items():
+            fuzzdict[key].append(value)
     return fuzzdict
 
 
-def get_fuzz(valuelist, no_of_fuzzcases, radamsacmd):
+def iter_fuzz_values(valuedict, no_of_fuzzcases, radamsacmd, seed=None,
+                     processes=None, cache=None, chunk_size=1000):
+    """Run every key's valid value list through a fuzzer, a chunk of fuzz
+    cases at a time, and yield the fuzz cases one by one as dicts with a
+    fuzz case for each key (see dictwalker.py). Only one chunk is kept in
+    memory, while the next one is being generated.
+
+    A seeded run uses the seed for the first chunk and a seed derived
+    from it for the others, so the fuzz cases depend on the chunk size.
+
+    :param valuedict: Dict of collected valid values
+    :param no_of_fuzzcases: How many injection cases to produce
+    :param radamsacmd: Command to run Radamsa
+    :param seed: Random seed for Radamsa, or None for a random run
+    :param processes: How many Radamsa processes to run at a time, by
+    default one per CPU
+    :param cache: A FuzzCache for reusing the fuzz cases of earlier runs
+    :param chunk_size: How many fuzz cases to generate at a time
+    """
+    # Keys without values of their own (such as keys of nested objects)
+    # use the samples under the None key, so their fuzz cases are
+    # generated once together with those of the None key
+    keys = [key for key in valuedict.keys()
+            if key is None or valuedict[key] != []]
+    chunks = []
+    for start in range(0, int(no_of_fuzzcases), chunk_size):
+        chunk_seed = seed
+        if seed is not None and start > 0:
+            chunk_seed = int(hashlib.sha1(("%s:%s" % (seed, start)).encode(
+                'utf-8')).hexdigest()[:8], 16)
+        chunks.append((min(chunk_size, int(no_of_fuzzcases) - start),
+                       chunk_seed))
+
+    # Radamsa does the work in its own processes, so threads are enough to
+    # keep several of them running
+    pool = ThreadPool(processes or multiprocessing.cpu_count())
+
+    def generate(chunk):
+        return pool.map_async(
+            lambda key: get_cached_fuzz(valuedict[key], chunk[0], radamsacmd,
+                                        chunk[1], cache), keys)
+
+    try:
+        pending = None
+        if chunks:
+            pending = generate(chunks[0])
+        for index in range(len(chunks)):
+            fuzzlists = pending.get()
+            # Generate the next chunk while this one is being injected
+            if index + 1 < len(chunks):
+                pending = generate(chunks[index + 1])
+            for values in zip(*fuzzlists):
+                fuzzcase = dict(zip(keys, values))
+                for key in valuedict.keys():
+                    if key not in fuzzcase:
+                        fuzzcase[key] = fuzzcase[None]
+                yield fuzzcase
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_cached_fuzz(valuelist, no_of_fuzzcases, radamsacmd, seed=None,
+                    cache=None):
+    """Return the fuzz cases for a set of valid values from the cache, or
+    run Radamsa and cache the result. The parameters are as for get_fuzz().
+    """
+    if cache is None or seed is None:
+        return get_fuzz(valuelist, no_of_fuzzcases, radamsacmd, seed)
+    key = cache.key(valuelist, no_of_fuzzcases, seed,
+                    radamsa_version(radamsacmd))
+    fuzzlist = cache.get(key)
+    if fuzzlist is None:
+        fuzzlist = get_fuzz(valuelist, no_of_fuzzcases, radamsacmd, seed)
+        cache.put(key, fuzzlist)
+    return fuzzlist
+
+
+class FuzzCache(object):
+    """A directory of Radamsa outputs from earlier runs, one file for each
+    set of valid values, fuzz case count, seed and Radamsa version. When
+    the files take more than the given space, the least recently used
+    ones are removed. Several processes can share the directory.
+
+    Each file starts with CACHE_MAGIC, followed by the fuzz cases, each
+    as a 4-byte big-endian length and the bytes of the case. The files are
+    plain data, so a cache directory written by others is safe to read.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        """
+        :param directory: Directory for the cache files
+        :param max_bytes: How much space the cache may take
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(valuelist, no_of_fuzzcases, seed, version):
+        """:return: The cache key for a Radamsa run"""
+        return hashlib.sha1(repr([valuelist, int(no_of_fuzzcases), seed,
+                                  version]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """:return: The cached fuzz cases, or None"""
+        path = os.path.join(self.directory, key + '.fuzz')
+        try:
+            with open(path, 'rb') as cachefile:
+                fuzzlist = read_cases(cachefile)
+        except (IOError, OSError, ValueError):
+            return None  # Missing or damaged
+        try:
+            os.utime(path, None)  # Mark as recently used
+        except OSError:
+            pass  # Evicted by another process in between
+        return fuzzlist
+
+    def put(self, key, fuzzlist):
+        """Store fuzz cases, and evict old ones if the cache is full"""
+        path = os.path.join(self.directory, key + '.fuzz')
+        # Write to a private file first, so that other processes never see
+        # a partial file
+        temporary_path = "%s.%s.%s.tmp" % (path, os.getpid(),
+                                           threading.current_thread().ident)
+        with open(temporary_path, 'wb') as cachefile:
+            write_cases(cachefile, fuzzlist)
+        os.rename(temporary_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.fuzz'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+CACHE_MAGIC = b'mittn fuzz cache 1\n'
+
+
+def write_cases(cachefile, fuzzlist):
+    """Write fuzz cases into a cache file, see FuzzCache"""
+    cachefile.write(CACHE_MAGIC)
+    for fuzzcase in fuzzlist:
+        if not isinstance(fuzzcase, bytes):  # Python 3 text
+            fuzzcase = fuzzcase.encode('utf-8')
+        cachefile.write(struct.pack('>I', len(fuzzcase)))
+        cachefile.write(fuzzcase)
+
+
+def read_cases(cachefile):
+    """Read fuzz cases from a cache file, see FuzzCache
+
+    :return: A list of fuzz cases as native strings, like get_fuzz()
+    returns them
+    :raises ValueError: If the file is not a complete cache file
+    """
+    if cachefile.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+        raise ValueError("Not a fuzz cache file")
+    fuzzlist = []
+    while True:
+        header = cachefile.read(4)
+        if len(header) == 0:
+            return fuzzlist
+        if len(header) != 4:
+            raise ValueError("Truncated fuzz cache file")
+        length = struct.unpack('>I', header)[0]
+        fuzzcase = cachefile.read(length)
+        if len(fuzzcase) != length:
+            raise ValueError("Truncated fuzz cache file")
+        if str is not bytes:  # Python 3
+            fuzzcase = fuzzcase.decode('utf-8')
+        fuzzlist.append(fuzzcase)
+
+
+# Radamsa versions by command
+radamsa_versions = {}
+
+
+def radamsa_version(radamsacmd):
+    """:return: The version string that Radamsa reports"""
+    if radamsacmd not in radamsa_versions:
+        try:
+            radamsa_versions[radamsacmd] = subprocess.check_output(
+                [radamsacmd, "--version"], stderr=subprocess.STDOUT).strip()
+        except (subprocess.CalledProcessError, OSError) as error:
+            assert False, "Could not execute Radamsa: %s" % error
+    return radamsa_versions[radamsacmd]
+
+
+def get_fuzz(valuelist, no_of_fuzzcases, radamsacmd, seed=None):
     """Run Radamsa on a set of valid values
 
     :param valuelist: Valid cases to feed to Radamsa
     :param no_of_fuzzcases: Number of fuzz cases to generate
     :param radamsacmd: Command to run Radamsa
+    :param seed: Random seed for Radamsa, or None for a random run
     :return:
     """
 
     # Radamsa is a file-based fuzzer so we need to write the valid strings
-    # out to files
-    valid_case_directory = tempfile.mkdtemp()
-    fuzz_case_directory = tempfile.mkdtemp()
-    for valid_string in valuelist:
-        tempfilehandle = tempfile.mkstemp(suffix='.case',
-                                          dir=valid_case_directory)
-        with os.fdopen(tempfilehandle[0], "w") as filehandle:
-            # Radamsa only operates on strings, so make numbers and booleans
-            # into strings. (No, this won't fuzz effectively, use static
-            # injection to cover those cases.)
-            if isinstance(valid_string, (bool, int, long, float)):
-                valid_string = str(valid_string)
-            filehandle.write(bytearray(valid_string, "UTF-8"))
-
-    # Run Radamsa
+    # out to files. The files are numbered, so that a seeded run sees
+    # them in the same order each time.
+    work_directory = tempfile.mkdtemp()
+    valid_case_directory = os.path.join(work_directory, "valid")
+    fuzz_case_directory = os.path.join(work_directory, "fuzz")
+    os.mkdir(valid_case_directory)
+    os.mkdir(fuzz_case_directory)
     try:
-        subprocess.check_call(
-            [radamsacmd, "-o", fuzz_case_directory + "/%n.fuzz", "-n",
-             str(no_of_fuzzcases), "-r", valid_case_directory])
-    except subprocess.CalledProcessError as error:
-        assert False, "Could not execute Radamsa: %s" % error
+        for index, valid_string in enumerate(valuelist):
+            filename = os.path.join(valid_case_directory, "%d.case" % index)
+            with open(filename, "wb") as filehandle:
+                # Radamsa only operates on strings, so make numbers and
+                # booleans into strings. (No, this won't fuzz effectively,
+                # use static injection to cover those cases.)
+                if isinstance(valid_string, (bool, int, long, float)):
+                    valid_string = str(valid_string)
+                filehandle.write(bytearray(valid_string, "UTF-8"))
 
-    # Read the fuzz cases from the output directory and return as list
-    fuzzlist = []
-    for filename in os.listdir(fuzz_case_directory):
-        filehandle = open(fuzz_case_directory + "/" + filename, "r")
-        fuzzlist.append(filehandle.read())
-    shutil.rmtree(valid_case_directory)
-    shutil.rmtree(fuzz_case_directory)
+        # Run Radamsa
+        command = [radamsacmd, "-o", fuzz_case_directory + "/%n.fuzz", "-n",
+                   str(no_of_fuzzcases), "-r", valid_case_directory]
+        if seed is not None:
+            command += ["-s", str(seed)]
+        try:
+            subprocess.check_call(command)
+        except subprocess.CalledProcessError as error:
+            assert False, "Could not execute Radamsa: %s" % error
+
+        # Read the fuzz cases from the output directory and return as list,
+        # in the order Radamsa generated them
+        fuzzlist = []
+        filenames = sorted(os.listdir(fuzz_case_directory),
+                           key=lambda name: int(name.split('.')[0]))
+        for filename in filenames:
+            with open(os.path.join(fuzz_case_directory, filename), "r") as \
+                    filehandle:
+                fuzzlist.append(filehandle.read())
+    finally:
+        shutil.rmtree(work_directory)
     return fuzzlist
@@ -1,9 +1,13 @@
 """Send a request to server using a variety of ways and return the results."""
 import requests
+import requests.adapters
+from requests.compat import urljoin, urlparse
 import logging
 import json
 import socket  # For getting local hostname & IP for the abuse header
 import datetime  # For timestamps
+import threading
+import time
 
 __copyright__ = "Copyright (c) 2013- F-Secure"
 
@@ -30,18 +34,54 @@ def send_http(context, submission, timeout=5, proxy=None,
         assert False, "Target URI not specified"
     uri = context.targeturi
 
-    proxydict = None  # Default is no proxies
-    if proxy is not None:
-        proxydict = {'http': 'http://' + proxy, 'https': 'https://' + proxy}
     response_list = []  # We return list of responses we got
 
-    response = {}
+    template = request_template(context, content_type, proxy)
+    req = template.prepare(method, submission, auth)
+    response = new_response(req, submission, uri, method, scenario_id)
+
+    # Next, perform the request
+    get_transport(context).send(req, response, timeout, template.proxy)
+    response_list.append(response)
+    return response_list
+
+
+def send_http_async(context, submission, timeout=5, proxy=None,
+                    content_type='application/x-www-form-urlencoded; charset="utf-8"',
+                    scenario_id=0, auth=None, method='POST', callback=None):
+    """Like send_http(), but hand the request over to an event loop
+    based transport and return immediately
+
+    :param context: The Behave context
+    :param callback: Function to call with the response dict once the
+    response is in (optional); called from the transport's thread
+    :return: A pending response; its get() returns what send_http() would
+    """
+    logging.getLogger("requests").setLevel(logging.WARNING)
+
+    if not hasattr(context, "targeturi"):
+        assert False, "Target URI not specified"
+    uri = context.targeturi
+
+    template = request_template(context, content_type, proxy)
+    req = template.prepare(method, submission, auth)
+    response = new_response(req, submission, uri, method, scenario_id)
+    return get_transport(context).submit(req, response, timeout,
+                                         template.proxy, callback)
+
 
-    req = create_http_request(method,
-                              uri,
-                              content_type,
-                              submission,
-                              auth)
+def new_response(req, submission, uri, method, scenario_id):
+    """Create the response dict for a request, with the request data
+    filled in and the response data set to defaults
+
+    :param req: Requests prepared request
+    :param submission: Data to be sent (body or GET parameters)
+    :param uri: URL to send the data to
+    :param method: HTTP method to be used
+    :param scenario_id: User specified scenario identifier from feature file
+    :return: A dict of request and response data
+    """
+    response = {}
 
     # Store the actual request & submission bytes for reference
     response['req_headers'] = json.dumps(dict(req.headers))
@@ -56,28 +96,356 @@ def send_http(context, submission, timeout=5, proxy=None,
     response['resp_body'] = ""  # Default
     response['resp_history'] = ""  # Default
     response['timestamp'] = datetime.datetime.utcnow()
+    return response
 
-    # Next, perform the request
-    session = requests.Session()
-    try:
-        resp = session.send(req, timeout=timeout, verify=False,
-                            proxies=proxydict, allow_redirects=True)
-
-    # Catalogue any errors and save responses for inspection
-    except requests.exceptions.Timeout:
-        response['server_timeout'] = True
-    except requests.exceptions.RequestException as error:
-        response['server_protocol_error'] = error
-    else:  # Valid response, store response data
-        response['resp_statuscode'] = resp.status_code  # Response code
-        response['resp_headers'] = json.dumps(dict(resp.headers))  # Header dict
-        response['resp_body'] = resp.content  # Bytes in body
-        response['resp_history'] = resp.history  # Redirection history
-    response_list.append(response)
-    return response_list
 
+def get_transport(context):
+    """Return the HTTP transport selected for this run, creating it on
+    first use. The transport is selected through context.http_transport
+    (one of the keys in TRANSPORTS), and defaults to blocking Requests.
+
+    :param context: The Behave context
+    :return: A transport object
+    """
+    if getattr(context, 'http_transport_instance', None) is None:
+        name = getattr(context, 'http_transport', 'requests')
+        if name not in TRANSPORTS:
+            assert False, "Unknown HTTP transport %s, must be one of %s" % (
+                name, ", ".join(sorted(TRANSPORTS.keys())))
+        context.http_transport_instance = TRANSPORTS[name](context)
+    return context.http_transport_instance
+
+
+def close_transport(context):
+    """Release the HTTP transport and any persistent connections of this
+    run
+
+    :param context: The Behave context
+    """
+    if getattr(context, 'http_transport_instance', None) is not None:
+        context.http_transport_instance.close()
+        context.http_transport_instance = None
+    with session_lock:
+        sessions = getattr(context, 'http_sessions', None)
+        context.http_sessions = None
+    if sessions is not None:
+        for session in sessions.values():
+            session.close()
+
+
+def persistent_connections(context):
+    """:return: True if connections to the target should be kept open"""
+    return getattr(context, 'persistent_connections', False) is True
+
+
+def http_session(context, proxy=None):
+    """Return a Requests session for sending to the target. By default,
+    each request gets a fresh session (and a fresh connection). With
+    persistent connections, there is one long-lived session per target
+    and proxy, shared by all senders of the scenario.
+
+    The connection pool of a shared session reconnects by itself when
+    the server has closed a connection. Retries are disabled, so if the
+    server drops the connection while processing an injection, that
+    request still fails with a protocol error, and the next request gets
+    a new connection.
+
+    :param context: The Behave context
+    :param proxy: Proxy specification, or None
+    :return: A Requests session
+    """
+    if not persistent_connections(context):
+        return requests.Session()
+    with session_lock:
+        if getattr(context, 'http_sessions', None) is None:
+            context.http_sessions = {}
+        key = (context.targeturi, proxy)
+        if key not in context.http_sessions:
+            pool_size = max(getattr(context, 'concurrency', 1), 1)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size,
+                                                    max_retries=0)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            context.http_sessions[key] = session
+        return context.http_sessions[key]
+
+
+class RequestsTransport(object):
+    """Blocking transport that sends each request with Requests"""
+
+    asynchronous = False
+
+    def __init__(self, context):
+        self.context = context
+
+    def send(self, req, response, timeout, proxy):
+        """Send a request and store the results in the response dict
+
+        :param req: Requests prepared request
+        :param response: The response dict from new_response()
+        :param timeout: Timeout value
+        :param proxy: Proxy specification, or None
+        """
+        proxydict = None  # Default is no proxies
+        if proxy is not None:
+            proxydict = {'http': 'http://' + proxy,
+                         'https': 'https://' + proxy}
+        session = http_session(self.context, proxy)
+        start = time.time()
+        try:
+            resp = session.send(req, timeout=timeout, verify=False,
+                                proxies=proxydict, allow_redirects=True)
+
+        # Catalogue any errors and save responses for inspection
+        except requests.exceptions.Timeout:
+            response['server_timeout'] = True
+        except requests.exceptions.RequestException as error:
+            response['server_protocol_error'] = error
+        else:  # Valid response, store response data
+            response['resp_statuscode'] = resp.status_code  # Response code
+            response['resp_headers'] = json.dumps(dict(resp.headers))  # Header dict
+            response['resp_body'] = resp.content  # Bytes in body
+            response['resp_history'] = resp.history  # Redirection history
+        response['elapsed'] = time.time() - start
+
+    def submit(self, req, response, timeout, proxy, callback=None):
+        """Blocking transports complete the request before returning"""
+        self.send(req, response, timeout, proxy)
+        if callback is not None:
+            callback(response)
+        return CompletedResponse(response)
+
+    def close(self):
+        pass
+
+
+class AsyncTransport(object):
+    """Event loop transport that keeps a large number of requests in
+    flight from a single thread. Built on the Tornado asynchronous HTTP
+    client, which runs on asyncio where that is available. The requests
+    are still prepared by Requests, so headers and auth objects work in
+    the same way as with the blocking transport.
+    """
+
+    asynchronous = True
+
+    def __init__(self, context):
+        try:
+            from tornado import ioloop, httpclient
+        except ImportError:
+            assert False, "The async HTTP transport requires Tornado " \
+                          "(pip install tornado)"
+        self.httpclient = httpclient
+        self.max_clients = max(getattr(context, 'concurrency', 1), 10)
+        self.clients = {}
+        self.ioloop = ioloop.IOLoop()
+        self.thread = threading.Thread(target=self.ioloop.start)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, req, response, timeout, proxy):
+        """Send a request and wait for the response"""
+        self.submit(req, response, timeout, proxy).get()
+
+    def submit(self, req, response, timeout, proxy, callback=None):
+        """Queue a request on the event loop
+
+        :return: A PendingResponse that completes when the response is in
+        """
+        pending = PendingResponse(response, callback)
+        self.ioloop.add_callback(self._fetch, req, pending, timeout, proxy)
+        return pending
+
+    def _client(self, proxy):
+        # Runs in the event loop thread. Only the curl based client
+        # supports proxies, so it is used only when needed.
+        if proxy not in self.clients:
+            if proxy is None:
+                from tornado.simple_httpclient import SimpleAsyncHTTPClient
+                client_class = SimpleAsyncHTTPClient
+            else:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                client_class = CurlAsyncHTTPClient
+            self.clients[proxy] = client_class(force_instance=True,
+                                               max_clients=self.max_clients)
+        return self.clients[proxy]
+
+    def _fetch(self, req, pending, timeout, proxy):
+        # Runs in the event loop thread
+        self._fetch_hop(pending, time.time(), timeout, proxy, req.method,
+                        req.url, dict(req.headers), req.body, [])
+
+    def _fetch_hop(self, pending, start, timeout, proxy, method, url,
+                   headers, body, history):
+        # Runs in the event loop thread. Redirects are followed here
+        # instead of by Tornado, so that the redirection history can be
+        # recorded in the same way as the blocking transport records it.
+        proxy_host, proxy_port = None, None
+        if proxy is not None:
+            proxy_host, proxy_port = proxy.rsplit(':', 1)
+            proxy_port = int(proxy_port)
+        request = self.httpclient.HTTPRequest(
+            url, method=method, headers=headers, body=body,
+            request_timeout=timeout, validate_cert=False,
+            follow_redirects=False, allow_nonstandard_methods=True,
+            proxy_host=proxy_host, proxy_port=proxy_port)
+        try:
+            future = self._client(proxy).fetch(request, raise_error=False)
+        except Exception as error:
+            pending.response['server_protocol_error'] = error
+            pending.response['elapsed'] = time.time() - start
+            pending.done()
+            return
+        self.ioloop.add_future(
+            future, lambda f: self._store(f, request, pending, start,
+                                          timeout, proxy, history))
+
+    def _store(self, future, request, pending, start, timeout, proxy,
+               history):
+        # Runs in the event loop thread; map the Tornado results to the
+        # same fields the blocking transport stores
+        response = pending.response
+        response['elapsed'] = time.time() - start
+        try:
+            resp = future.result()
+            if resp.code == 599:  # Tornado's code for no HTTP response
+                raise resp.error
+        except Exception as error:
+            # Depending on the Tornado version, timeouts are either
+            # socket timeouts or HTTP errors with the code 599
+            if isinstance(error, socket.timeout) or (
+                    getattr(error, 'code', None) == 599 and
+                    'timeout' in str(error).lower()):
+                response['server_timeout'] = True
+            else:
+                response['server_protocol_error'] = error
+            pending.done()
+            return
+        location = resp.headers.get('Location')
+        if resp.code in REDIRECT_CODES and location:
+            if len(history) >= requests.models.DEFAULT_REDIRECT_LIMIT:
+                response['server_protocol_error'] = \
+                    requests.exceptions.TooManyRedirects(
+                        'Exceeded %s redirects.' %
+                        requests.models.DEFAULT_REDIRECT_LIMIT)
+                pending.done()
+                return
+            history = history + [redirect_hop(request.url, resp)]
+            method, url, headers, body = redirected_request(
+                request.method, request.url, dict(request.headers),
+                request.body, resp.code, location)
+            self._fetch_hop(pending, start, timeout, proxy, method, url,
+                            headers, body, history)
+            return
+        response['resp_statuscode'] = resp.code
+        response['resp_headers'] = json.dumps(dict(resp.headers))
+        response['resp_body'] = resp.body or ""
+        response['resp_history'] = history  # Redirection history
+        pending.done()
 
-def create_http_request(method, uri, content_type, submission, auth=None, valid_case=False):
+    def close(self):
+        def stop():
+            for client in self.clients.values():
+                client.close()
+            self.ioloop.stop()
+        self.ioloop.add_callback(stop)
+        self.thread.join()
+        self.ioloop.close()
+
+
+class CompletedResponse(object):
+    """A response that is already available"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def get(self):
+        """:return: The response list, like send_http() returns"""
+        return [self.response]
+
+
+# Status codes of the redirects that the async transport follows
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def redirect_hop(url, resp):
+    """Record a redirect received by the async transport as a Requests
+    response, like the ones in the history of a blocking request
+
+    :param url: URL that redirected
+    :param resp: The Tornado response
+    :return: A requests.Response without a body
+    """
+    hop = requests.Response()
+    hop.url = url
+    hop.status_code = resp.code
+    hop.reason = resp.reason
+    hop.headers = requests.structures.CaseInsensitiveDict(resp.headers)
+    return hop
+
+
+def redirected_request(method, url, headers, body, code, location):
+    """Build the request that follows a redirect, changing the method and
+    dropping the body, content headers and credentials in the same way as
+    Requests does
+
+    :return: A (method, URL, headers, body) tuple
+    """
+    new_url = urljoin(url, location)
+    if code in (302, 303) and method != 'HEAD':
+        method = 'GET'
+    elif code == 301 and method == 'POST':
+        method = 'GET'
+    if code not in (307, 308):
+        body = None
+        for name in list(headers.keys()):
+            if name.lower() in ('content-length', 'content-type',
+                                'transfer-encoding'):
+                del headers[name]
+    if urlparse(new_url).hostname != urlparse(url).hostname:
+        for name in list(headers.keys()):
+            if name.lower() == 'authorization':
+                del headers[name]
+    return method, new_url, headers, body
+
+
+class PendingResponse(object):
+    """A response that is filled in by an event loop transport"""
+
+    def __init__(self, response, callback=None):
+        self.response = response
+        self.callback = callback
+        self.event = threading.Event()
+
+    def done(self):
+        try:
+            if self.callback is not None:
+                self.callback(self.response)
+        finally:
+            self.event.set()
+
+    def get(self):
+        """Wait for the response
+
+        :return: The response list, like send_http() returns
+        """
+        # Wait in slices; an Event.wait() without timeout cannot be
+        # interrupted with Ctrl-C on Python 2
+        while not self.event.wait(1):
+            pass
+        return [self.response]
+
+
+session_lock = threading.Lock()
+
+TRANSPORTS = {'requests': RequestsTransport,
+              'async': AsyncTransport}
+
+
+def create_http_request(method, uri, content_type, submission, auth=None,
+                        valid_case=False, keep_alive=False):
     # Set up some headers
     """Create and return a Requests HTTP request object. In a separate
     function to allow reuse.
@@ -87,18 +455,11 @@ def create_http_request(method, uri, content_type, submission, auth=None, valid_
     :param content_type: Content type of data to be sent
     :param submission: Data to be sent
     :param auth: Requests Auth object from authenticate.py
+    :param valid_case: True if this is a valid case instrumentation request
+    :param keep_alive: True to allow the server to keep the connection open
     :return: Requests HTTP request object
     """
-    headers = {'Content-Type': content_type,
-               'Cache-Control': 'no-cache',
-               'User-Agent': 'Mozilla/5.0 (compatible; Mittn HTTP '
-                             'Fuzzer-Injector)',
-               'X-Abuse': 'This is an automatically generated robustness test '
-                          'request from %s [%s]' % (socket.getfqdn(), socket.gethostbyname(socket.gethostname())),
-               'Connection': 'close'}
-
-    if valid_case is True:
-        headers['X-Valid-Case-Instrumentation'] = 'This is a valid request that should succeed'
+    headers = request_headers(content_type, valid_case, keep_alive)
 
     if method == 'GET':  # Inject into URI parameter
         req = requests.Request(method=method, headers=headers,
@@ -108,3 +469,108 @@ def create_http_request(method, uri, content_type, submission, auth=None, valid_
         req = requests.Request(method=method, headers=headers, url=uri,
                                data=submission, auth=auth).prepare()
     return req
+
+
+def request_headers(content_type, valid_case=False, keep_alive=False):
+    """Return the headers that go into every request
+
+    :param content_type: Content type of data to be sent
+    :param valid_case: True if this is a valid case instrumentation request
+    :param keep_alive: True to allow the server to keep the connection open
+    :return: A dict of headers
+    """
+    headers = {'Content-Type': content_type,
+               'Cache-Control': 'no-cache',
+               'User-Agent': 'Mozilla/5.0 (compatible; Mittn HTTP '
+                             'Fuzzer-Injector)',
+               'X-Abuse': abuse_header(),
+               'Connection': 'close'}
+
+    if keep_alive is True:
+        headers['Connection'] = 'keep-alive'
+
+    if valid_case is True:
+        headers['X-Valid-Case-Instrumentation'] = 'This is a valid request that should succeed'
+    return headers
+
+
+abuse_header_value = None  # Cached by abuse_header()
+
+
+def abuse_header():
+    """Return the X-Abuse header value that tells where the requests come
+    from. The local host name and address are only looked up once, as
+    the lookups may need a DNS round trip.
+    """
+    global abuse_header_value
+    if abuse_header_value is None:
+        abuse_header_value = 'This is an automatically generated robustness ' \
+                             'test request from %s [%s]' % (
+                                 socket.getfqdn(),
+                                 socket.gethostbyname(socket.gethostname()))
+    return abuse_header_value
+
+
+def request_template(context, content_type, proxy=None):
+    """Return the request template of this scenario for a content type
+    and proxy, creating it on first use
+
+    :param context: The Behave context
+    :param content_type: Content type of data to be sent
+    :param proxy: Proxy specification, or None
+    :return: A RequestTemplate
+    """
+    key = (context.targeturi, content_type, proxy,
+           persistent_connections(context))
+    templates = getattr(context, 'request_templates', None)
+    if templates is None:
+        templates = context.request_templates = {}
+    if key not in templates:
+        templates[key] = RequestTemplate(context.targeturi, content_type,
+                                         proxy,
+                                         persistent_connections(context))
+    return templates[key]
+
+
+class RequestTemplate(object):
+    """The parts of the injection requests that stay the same for the
+    whole scenario: target, headers and proxy. The headers are resolved
+    and a request is prepared once per method, and for each case only
+    the query string or the body and the auth are filled in.
+    """
+
+    def __init__(self, uri, content_type, proxy=None, keep_alive=False):
+        """
+        :param uri: URL to send the data to
+        :param content_type: Content type of data to be sent
+        :param proxy: Proxy specification, or None
+        :param keep_alive: True to allow the server to keep the connection open
+        """
+        self.uri = uri
+        self.proxy = proxy
+        self.headers = request_headers(content_type, keep_alive=keep_alive)
+        self.prepared = {}  # HTTP method -> prepared request without data
+
+    def prepare(self, method, submission, auth=None):
+        """Create a Requests HTTP request object, like create_http_request()
+
+        :param method: HTTP method to be used
+        :param submission: Data to be sent
+        :param auth: Requests Auth object from authenticate.py
+        :return: Requests HTTP request object
+        """
+        if method not in self.prepared:
+            self.prepared[method] = requests.Request(
+                method=method, headers=self.headers, url=self.uri).prepare()
+        req = self.prepared[method].copy()
+        # The copy shares the hook lists of the template; give it lists of
+        # its own, as auth objects such as digest auth register hooks
+        req.hooks = dict((event, list(hooks)) for event, hooks in
+                         self.prepared[method].hooks.items())
+        if method == 'GET':  # Inject into URI parameter
+            req.prepare_url(str(self.uri) + submission, None)
+        else:  # Inject into request body
+            req.prepare_body(submission, None)
+        # Auth comes last, as it may need to see the rest of the request
+        req.prepare_auth(auth)
+        return req
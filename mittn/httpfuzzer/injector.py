@@ -5,7 +5,13 @@ from mittn.httpfuzzer.posttools import *
 from features.authenticate import authenticate
 import requests
 import logging
+import collections
+import threading
+import time
+import hashlib
+from multiprocessing.pool import ThreadPool
 from mittn.httpfuzzer.url_params import *
+from mittn.httpfuzzer.ratecontrol import AdaptiveRateController
 
 __copyright__ = "Copyright (c) 2013- F-Secure"
 
@@ -15,6 +21,19 @@ def inject(context, injection_list):
 
     :param context: The Behave context
     :param injection_list: An anomaly dictionary, see dictwalker.py
+    :return: A list of response dicts, see httptools.py
+    """
+    return list(iter_inject(context, injection_list))
+
+
+def iter_inject(context, injection_list):
+    """Inject the payload and yield the results one at a time as they
+    come in, so that the caller can process them without keeping all of
+    them in memory
+
+    :param context: The Behave context
+    :param injection_list: An anomaly dictionary, see dictwalker.py
+    :return: Response dicts, see httptools.py
     """
 
     # Get the user-supplied list of HTTP methods that we will inject with
@@ -23,49 +42,553 @@ def inject(context, injection_list):
     else:
         methods = ['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'HEAD', 'PATCH']
 
-    responses = []
-    for injection in injection_list:
-        # Walk through the submission and inject at every key, value
-        for injected_submission in dictwalk(context.submission[0], injection):
+    if hasattr(context, 'proxy_address') is False:
+        context.proxy_address = None
+
+    cases = injection_cases(context, injection_list, methods)
+    duplicates = None
+    if getattr(context, 'skip_duplicate_injections', False) is True:
+        # Identical requests are only sent once
+        duplicates = DuplicateFilter(getattr(context, 'journal', None))
+        cases = duplicates.filter(cases)
+
+    concurrency = getattr(context, 'concurrency', 1)
+    if hasattr(context, 'adaptive_rate'):
+        context.rate_controller = AdaptiveRateController(
+            context.adaptive_rate,
+            baseline_latency=getattr(context, 'baseline_latency', None),
+            max_concurrency=concurrency)
+    pool = None
+    if concurrency > 1 and not get_transport(context).asynchronous:
+        # Send the cases through a pool of worker threads, at most
+        # "concurrency" requests in flight towards the target at a time
+        pool = ThreadPool(concurrency)
+
+        def submit(case):
+            return pool.apply_async(send_injection, (context, case))
+    else:
+        # Either the transport keeps the requests in flight by itself,
+        # or we send them one by one
+        def submit(case):
+            return submit_injection(context, case)
+    monitor = None
+    if hasattr(context, "valid_case_instrumentation"):
+        # By default, the valid case is tried after every injection
+        every_seconds = getattr(context, 'valid_case_every_seconds', None)
+        every_requests = getattr(context, 'valid_case_every_requests',
+                                 1 if every_seconds is None else None)
+        monitor = ValidCaseMonitor(
+            context, every_requests=every_requests,
+            every_seconds=every_seconds,
+            background=getattr(context, 'valid_case_background', False))
+    # Keep some cases queued up ahead so that the senders never idle
+    window = concurrency * 2 if concurrency > 1 else 1
+    try:
+        for case, response_list in ordered_map(submit, cases, window):
+            for response in response_list:
+                response['case_key'] = case.key
+                response['mutation'] = case.mutation
+                yield response
+            if monitor is not None:
+                monitor.injected(case)
+        if monitor is not None:
+            monitor.finish()
+    finally:
+        if monitor is not None:
+            monitor.stop()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        close_transport(context)
+        context.skipped_duplicates = 0
+        if duplicates is not None and duplicates.skipped > 0:
+            context.skipped_duplicates = duplicates.skipped
+            logging.getLogger(__name__).info(
+                "Scenario %s: skipped %s injections that were identical to "
+                "earlier ones", context.scenario_id, duplicates.skipped)
+        if getattr(context, 'rate_controller', None) is not None:
+            context.settled_rate = context.rate_controller.rate
+            logging.getLogger(__name__).info(
+                "Scenario %s: injection rate settled at %.1f requests per "
+                "second after %s slowdowns", context.scenario_id,
+                context.settled_rate, context.rate_controller.decreases)
+
+
+# One injection request. The key (anomaly index, mutation index, method)
+# identifies the case within the scenario's injection space, and the
+# mutation tells where the anomaly was injected (see dictwalker.py).
+InjectionCase = collections.namedtuple('InjectionCase',
+                                       ['key', 'injected_submission',
+                                        'method', 'form_string',
+                                        'mutation'])
+
+
+def injection_cases(context, injection_list, methods):
+    """Generate the injection cases for a scenario, one at a time. Cases
+    that belong to another shard, or that a resumed run has already
+    completed, are skipped.
+
+    :param context: The Behave context
+    :param injection_list: An anomaly dictionary, see dictwalker.py
+    :param methods: HTTP methods to inject with
+    :return: InjectionCase tuples
+    """
+    journal = getattr(context, 'journal', None)
+    shard = shard_of(context)
+    for anomaly_index, injection in enumerate(injection_list):
+        # Walk through the submission and inject at every key, value.
+        # The mutated submission is only built if a case needs it.
+        for mutation_index, mutation in enumerate(
+                iter_mutations(context.submission[0], injection)):
+            injected_submission = None
             # Use each method
             for method in methods:
-                # Output according to what the original source was
-                # Send URL-encoded submissions
-                if context.type == 'urlencode':
-                    form_string = serialise_to_url(injected_submission, encode=True)
-                    if method == 'GET':
-                        form_string = '?' + form_string
-
-                # If the payload is in URL parameters (_not_ query)
-                if context.type == 'url-parameters':
-                    form_string = dict_to_urlparams(injected_submission)
-
-                # If the payload is JSON, send the raw thing
-                if context.type == 'json':
-                    form_string = serialise_to_json(injected_submission,
-                                                    encode=True)
-
-                if hasattr(context, 'proxy_address') is False:
-                    context.proxy_address = None
-
-                responses += send_http(context, form_string,
-                                       timeout=context.timeout,
-                                       proxy=context.proxy_address,
-                                       method=method,
-                                       content_type=context.content_type,
-                                       scenario_id=context.scenario_id,
-                                       auth=authenticate(context,
-                                                         context.authentication_id))
-
-                # Here, I'd really like to send out unencoded (invalid)
-                # JSON too, but the json library barfs too easily, so
-                # we concentrate on application layer input fuzzing.
-
-                if hasattr(context, "valid_case_instrumentation"):
-                    test_valid_submission(context, injected_submission)
+                key = (anomaly_index, mutation_index, method)
+                if shard is not None and not in_shard(key, shard):
+                    continue
+                if journal is not None and journal.completed(key):
+                    continue
+                if injected_submission is None:
+                    injected_submission = apply_mutation(
+                        context.submission[0], mutation)
+                form_string = serialise_submission(context,
+                                                   injected_submission,
+                                                   method)
+                yield InjectionCase(key, injected_submission, method,
+                                    form_string, mutation)
+
+
+def serialise_submission(context, submission, method):
+    """Serialise a submission for sending
+
+    :param context: The Behave context
+    :param submission: The unserialised submission
+    :param method: HTTP method to be used
+    :return: The query string (for GET) or the body
+    """
+    # Output according to what the original source was
+    # Send URL-encoded submissions
+    if context.type == 'urlencode':
+        form_string = serialise_to_url(submission, encode=True)
+        if method == 'GET':
+            form_string = '?' + form_string
+
+    # If the payload is in URL parameters (_not_ query)
+    if context.type == 'url-parameters':
+        form_string = dict_to_urlparams(submission)
+
+    # If the payload is JSON, send the raw thing
+    if context.type == 'json':
+        form_string = serialise_to_json(submission, encode=True)
+
+    # Here, I'd really like to send out unencoded (invalid)
+    # JSON too, but the json library barfs too easily, so
+    # we concentrate on application layer input fuzzing.
+    return form_string
+
+
+class DuplicateFilter(object):
+    """Drop injection cases that would send the same request as an
+    earlier case: the same method and the same serialised submission.
+    Different anomalies often serialise the same way, for example when
+    the submission repeats list items or Radamsa repeats an output.
+
+    Only the hashes of the most recent requests are remembered, so the
+    memory use is bounded; a repeat of an older request is sent again.
+    The skipped cases are recorded in the checkpoint journal, if there is
+    one, so that a resumed run does not send them either.
+    """
+
+    # How many request hashes to remember
+    max_entries = 100000
+
+    def __init__(self, journal=None):
+        """
+        :param journal: InjectionJournal of the scenario, or None
+        """
+        self.seen = collections.OrderedDict()
+        self.skipped = 0
+        self.journal = journal
+
+    def filter(self, cases):
+        """:param cases: InjectionCase tuples
+        :return: The cases that have not been seen recently
+        """
+        for case in cases:
+            body = case.form_string
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            digest = hashlib.sha1(case.method.encode('utf-8') + b'\0' +
+                                  body).digest()
+            if digest in self.seen:
+                # Refresh, so that frequent repeats stay remembered
+                del self.seen[digest]
+                self.seen[digest] = True
+                self.skipped += 1
+                if self.journal is not None:
+                    self.journal.record(case.key)
+                continue
+            self.seen[digest] = True
+            if len(self.seen) > self.max_entries:
+                self.seen.popitem(last=False)
+            yield case
+
+
+def shard_of(context):
+    """Return the shard of the injection space that this process covers.
+    The shard is given on the command line as "behave -D shard=i/N", where
+    N is the number of shards and i is between 1 and N.
+
+    :param context: The Behave context
+    :return: (i, N), or None if the whole space is covered
+    """
+    if hasattr(context, 'shard') is False:
+        context.shard = None
+        userdata = getattr(getattr(context, 'config', None), 'userdata', {})
+        if userdata.get('shard') is not None:
+            context.shard = parse_shard(userdata['shard'])
+    return context.shard
+
+
+def parse_shard(text):
+    """Parse a shard specification
+
+    :param text: "i/N"
+    :return: (i, N)
+    """
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        assert False, "Shard must be given as i/N, not %s" % text
+    if count < 1 or not 1 <= index <= count:
+        assert False, "Shard %s is out of range" % text
+    return index, count
+
+
+def in_shard(key, shard):
+    """Decide whether an injection case belongs to a shard. The decision
+    only depends on the case key, so every process that is given the same
+    scenario assigns each case to the same shard, and the shards together
+    cover each case exactly once.
+
+    :param key: (anomaly index, mutation index, method)
+    :param shard: (i, N), see shard_of()
+    :return: True if the case belongs to the shard
+    """
+    index, count = shard
+    digest = hashlib.sha1(('%d:%d:%s' % tuple(key)).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % count == index - 1
+
+
+def send_injection(context, case):
+    """Send out one injection case. This may be called from several
+    worker threads at a time.
+
+    :param context: The Behave context
+    :param case: An InjectionCase from injection_cases()
+    :return: A list of response dicts, see httptools.py
+    """
+    auth, done = start_request(context)
+    responses = None
+    try:
+        responses = send_http(context, case.form_string,
+                              timeout=context.timeout,
+                              proxy=context.proxy_address,
+                              method=case.method,
+                              content_type=context.content_type,
+                              scenario_id=context.scenario_id,
+                              auth=auth)
+    finally:
+        done(responses[0] if responses else None)
     return responses
 
 
+def submit_injection(context, case):
+    """Hand one injection case over to the transport. Blocking transports
+    complete the request before returning.
+
+    :param context: The Behave context
+    :param case: An InjectionCase from injection_cases()
+    :return: A pending response list, see httptools.py
+    """
+    auth, done = start_request(context)
+    try:
+        return send_http_async(context, case.form_string,
+                               timeout=context.timeout,
+                               proxy=context.proxy_address,
+                               method=case.method,
+                               content_type=context.content_type,
+                               scenario_id=context.scenario_id,
+                               auth=auth,
+                               callback=done)
+    except BaseException:
+        done(None)
+        raise
+
+
+def start_request(context):
+    """Wait until an injection request may be sent, and get the auth
+    material for it
+
+    :param context: The Behave context
+    :return: A tuple of (auth object, function to call with the response
+    dict when the response is in, or with None if the request could not
+    be sent)
+    """
+    controller = getattr(context, 'rate_controller', None)
+    sent_at = None
+    if controller is not None:
+        sent_at = controller.acquire()
+    try:
+        auth = get_auth(context)
+    except BaseException:
+        if controller is not None:
+            controller.release()
+        raise
+    cache = getattr(context, 'auth_cache', None)
+
+    def done(response):
+        if response is None:  # Not sent; only free the slot
+            if controller is not None:
+                controller.release()
+            return
+        if controller is not None:
+            controller.record(response, sent_at)
+        if cache is not None:
+            cache.check_response(context.authentication_id, auth, response)
+    return auth, done
+
+
+def get_auth(context, acquire_new_authenticator=False):
+    """Get auth material from authenticate.py, through the auth cache if
+    one is in use
+
+    :param context: The Behave context
+    :param acquire_new_authenticator: True to re-authenticate
+    :return: A Requests auth object
+    """
+    cache = getattr(context, 'auth_cache', None)
+    if cache is None:
+        return authenticate(context, context.authentication_id,
+                            acquire_new_authenticator=acquire_new_authenticator)
+    return cache.get(context, context.authentication_id,
+                     refresh=acquire_new_authenticator)
+
+
+def ordered_map(submit, iterable, window):
+    """Submit the items of an iterable for sending and yield the results
+    in the original order. Unlike Pool.imap(), at most "window" items are
+    taken from the iterable ahead of the results that have been consumed,
+    so long injection runs do not queue up all of their cases in memory.
+
+    :param submit: Function that starts processing an item and returns
+    an object whose get() waits for the result
+    :param iterable: Items to process
+    :param window: How many items may be pending at a time
+    :return: Tuples of (item, result)
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append((item, submit(item)))
+        if len(pending) >= window:
+            item, result = pending.popleft()
+            yield item, result.get()
+    while pending:
+        item, result = pending.popleft()
+        yield item, result.get()
+
+
+class ValidCaseMonitor(object):
+    """Valid case instrumentation: checks that the target still works
+    while injecting. The valid case can be tried after every N
+    injections, every T seconds, or continuously from a background
+    thread. When a check fails after more than one injection, the
+    injections sent since the last successful check are re-sent in
+    halves (bisection) to find the one that broke the target.
+    """
+
+    # How long to wait for the target to recover before bisecting
+    recovery_time = 30
+    # How many injections since the last good check are kept for bisection
+    max_suspects = 1024
+
+    def __init__(self, context, every_requests=1, every_seconds=None,
+                 background=False):
+        """
+        :param context: The Behave context
+        :param every_requests: Check after this many injections, or None
+        :param every_seconds: Check when this many seconds have passed
+        since the last check, or None
+        :param background: True to check every_seconds (default: 1) from a
+        background thread, without holding back the injections
+        """
+        self.context = context
+        self.every_requests = every_requests
+        self.every_seconds = every_seconds
+        self.suspects = collections.deque(maxlen=self.max_suspects)
+        self.sequence = 0  # Number of injections seen so far
+        self.last_check = time.time()
+        self.lock = threading.Lock()
+        self.failure = None  # Set by the background thread
+        self.thread = None
+        if background:
+            self.every_requests = None
+            if self.every_seconds is None:
+                self.every_seconds = 1
+            self.running = threading.Event()
+            self.running.set()
+            self.thread = threading.Thread(target=self.run_in_background)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def injected(self, case):
+        """Note that an injection case has been sent, and check the
+        target if it is time
+
+        :param case: An InjectionCase from injection_cases()
+        """
+        if self.every_requests == 1 and self.every_seconds is None:
+            # Check after every injection, there is nothing to bisect
+            test_valid_submission(self.context, case.injected_submission)
+            return
+        with self.lock:
+            self.sequence += 1
+            self.suspects.append((self.sequence, case))
+        if self.thread is not None:
+            if self.failure is not None:
+                self.fail(self.failure)
+            return
+        if (self.every_requests is not None and
+                len(self.suspects) >= self.every_requests) or \
+                (self.every_seconds is not None and
+                 time.time() - self.last_check >= self.every_seconds):
+            error = self.check(case.injected_submission)
+            if error is not None:
+                self.fail(error)
+
+    def check(self, injected_submission, after=None):
+        """Try the valid case
+
+        :param injected_submission: The last injection, for the report
+        :param after: If the check succeeds, injections up to this sequence
+        number are cleared of suspicion; by default, all that have been
+        seen so far
+        :return: None if the valid case worked, otherwise the error
+        """
+        with self.lock:
+            if after is None:
+                after = self.sequence
+        self.last_check = time.time()
+        try:
+            test_valid_submission(self.context, injected_submission)
+        except AssertionError as error:
+            return error
+        with self.lock:
+            while self.suspects and self.suspects[0][0] <= after:
+                self.suspects.popleft()
+        return None
+
+    def finish(self):
+        """Check the injections sent since the last check, at the end of
+        the injection run"""
+        self.stop()
+        if self.failure is not None:
+            self.fail(self.failure)
+        if self.suspects:
+            error = self.check(self.suspects[-1][1].injected_submission)
+            if error is not None:
+                self.fail(error)
+
+    def run_in_background(self):
+        while self.running.is_set() and self.failure is None:
+            time.sleep(self.every_seconds)
+            with self.lock:
+                if not self.suspects:
+                    continue
+                after = self.sequence
+                last = self.suspects[-1][1].injected_submission
+            try:
+                self.failure = self.check(last, after)
+            except Exception as error:
+                # Any other error (such as too many redirects) also means
+                # that the valid case failed; report it like an assertion
+                self.failure = AssertionError(
+                    "Valid case request failed: %s: %s" % (
+                        error.__class__.__name__, error))
+
+    def fail(self, error):
+        """Find the injection that broke the target and fail the run
+
+        :param error: The failed valid case assertion
+        """
+        self.stop()
+        with self.lock:
+            suspects = [case for sequence, case in self.suspects]
+        culprit = None
+        if len(suspects) > 1:
+            culprit = self.bisect(suspects)
+        if culprit is not None:
+            assert False, "%s. Bisection of the %s injections since the " \
+                          "last successful valid case found that the " \
+                          "target broke after %s request with submission " \
+                          "%s" % (error, len(suspects), culprit.method,
+                                  culprit.form_string)
+        raise error
+
+    def bisect(self, suspects):
+        """Re-send injections to find one after which the valid case fails
+
+        :param suspects: Injection cases, in the order they were sent
+        :return: The injection case, or None if it could not be found
+        """
+        while len(suspects) > 1:
+            if not self.recovered():
+                return None
+            half = suspects[:len(suspects) // 2]
+            if self.breaks_target(half):
+                suspects = half
+            else:
+                suspects = suspects[len(suspects) // 2:]
+        # By elimination, this is the last candidate; see that it really
+        # breaks the target
+        if self.recovered() and self.breaks_target(suspects):
+            return suspects[0]
+        return None
+
+    def breaks_target(self, cases):
+        """:return: True if the valid case fails after sending the cases"""
+        for case in cases:
+            send_injection(self.context, case)
+        try:
+            test_valid_submission(self.context,
+                                  cases[-1].injected_submission)
+        except AssertionError:
+            return True
+        return False
+
+    def recovered(self):
+        """Wait for the valid case to work again
+
+        :return: True if it does within the recovery time
+        """
+        deadline = time.time() + self.recovery_time
+        while True:
+            try:
+                test_valid_submission(self.context)
+                return True
+            except AssertionError:
+                if time.time() > deadline:
+                    return False
+                time.sleep(1)
+
+    def stop(self):
+        """Stop the background checks, if any"""
+        if self.thread is not None:
+            self.running.clear()
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+
+
 def test_valid_submission(context, injected_submission=None):
     """Test submitting the valid case (or the first of a list of valid cases)
     as a HTTP POST. The server has to respond with something sane. This ensures
@@ -116,10 +639,9 @@ def test_valid_submission(context, injected_submission=None):
     retry = 0
     while True:
         if retry == 1:  # On second try, recreate auth material
-            auth = authenticate(context, context.authentication_id,
-                                acquire_new_authenticator=True)
+            auth = get_auth(context, acquire_new_authenticator=True)
         else:
-            auth = authenticate(context, context.authentication_id)
+            auth = get_auth(context)
         retry += 1  # How many retries
         try:
             req = create_http_request(context.submission_method,
@@ -127,8 +649,10 @@ def test_valid_submission(context, injected_submission=None):
                                       context.content_type,
                                       data,
                                       auth,
-                                      valid_case=True)
-            session = requests.Session()
+                                      valid_case=True,
+                                      keep_alive=persistent_connections(context))
+            session = http_session(context,
+                                   getattr(context, 'proxy_address', None))
             resp = session.send(req,
                                 timeout=context.timeout,
                                 verify=False, proxies=proxydict)
@@ -159,5 +683,9 @@ def test_valid_submission(context, injected_submission=None):
                                            context.targeturi,
                                            injected_submission, resp.status_code)
 
-        # If we are here, the request was successful
+        # If we are here, the request was successful. The first valid
+        # case of the scenario gives the baseline for the target's response
+        # time.
+        if getattr(context, 'baseline_latency', None) is None:
+            context.baseline_latency = resp.elapsed.total_seconds()
         break  # Stop trying, continue with the test run
@@ -0,0 +1,101 @@
+"""A multi-pattern string matcher for finding error strings in response
+bodies.
+
+The matcher is an Aho-Corasick automaton, compiled into a table of
+byte transitions when the matcher is created. A body is then scanned
+in a single linear pass, however many patterns there are. Matching is
+done on bytes and is case insensitive for ASCII letters, like a
+re.IGNORECASE search on a byte string.
+
+"""
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+
+class MultiPatternMatcher(object):
+    """Find any of a set of literal strings in a body of data"""
+
+    def __init__(self, patterns):
+        """Compile the patterns into an automaton
+
+        :param patterns: List of strings to look for
+        """
+        self.patterns = list(patterns)
+        # The trie: goto[state] is a dict of byte -> state, and
+        # output[state] is the index of the pattern that ends in the state
+        goto = [{}]
+        output = [None]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for byte in to_bytes(pattern).lower():
+                if byte not in goto[state]:
+                    goto.append({})
+                    output.append(None)
+                    goto[state][byte] = len(goto) - 1
+                state = goto[state][byte]
+            if output[state] is None:  # Keep the first of duplicates
+                output[state] = index
+        if output[0] is not None:
+            # An empty pattern matches everything
+            self.transitions = None
+            self.output = output
+            return
+
+        # Compute the failure links breadth first, and fill in the
+        # transition table so that each state has a transition for every
+        # byte. A state also outputs the pattern of its failure state if
+        # it has none of its own, so that a pattern that ends inside a
+        # longer one is found.
+        transitions = [None] * len(goto)
+        transitions[0] = [goto[0].get(byte, 0) for byte in range(256)]
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        position = 0
+        while position < len(queue):
+            state = queue[position]
+            position += 1
+            if output[state] is None:
+                output[state] = output[fail[state]]
+            row = list(transitions[fail[state]])
+            for byte, next_state in goto[state].items():
+                fail[next_state] = transitions[fail[state]][byte]
+                row[byte] = next_state
+                queue.append(next_state)
+            transitions[state] = row
+        # Uppercase ASCII letters go where their lowercase versions go
+        for row in transitions:
+            for byte in range(ord('A'), ord('Z') + 1):
+                row[byte] = row[byte + 32]
+        self.transitions = transitions
+        self.output = output
+
+    def search(self, data, limit=None):
+        """Scan data for the patterns
+
+        :param data: Data to scan, bytes or text
+        :param limit: Scan at most this many bytes from the start, or
+        None to scan everything
+        :return: The pattern that matched first, or None if none matched
+        """
+        if self.transitions is None:
+            return self.patterns[self.output[0]]
+        data = to_bytes(data)
+        if limit is not None:
+            data = data[:limit]
+        transitions = self.transitions
+        output = self.output
+        state = 0
+        for byte in data:
+            state = transitions[state][byte]
+            if output[state] is not None:
+                return self.patterns[output[state]]
+        return None
+
+
+def to_bytes(data):
+    """Return data as a bytearray, encoding text as UTF-8"""
+    if data is None:
+        return bytearray()
+    if not isinstance(data, (bytes, bytearray)):
+        data = data.encode('utf-8')
+    return bytearray(data)
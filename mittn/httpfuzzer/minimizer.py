@@ -0,0 +1,197 @@
+"""Shrink the injection that caused a finding before it is stored.
+
+The injected value is minimised with delta debugging (ddmin): parts of
+it are removed for as long as the target still fails the same check
+when the smaller case is sent. Then the rest of the submission is
+pruned in the same way, by removing the keys that are not on the path
+to the injected value. The result is stored in the min_req_body column
+next to the original request body.
+
+Each step sends a request to the target, so the number of requests per
+finding is limited. The requests are paced by the adaptive rate control
+like the injections, if it is in use. Findings that do not reproduce
+when sent again are stored as they are.
+
+"""
+import copy
+import time
+from mittn.httpfuzzer.httptools import request_template, new_response, \
+    RequestsTransport
+from mittn.httpfuzzer.injector import start_request, serialise_submission
+from mittn.httpfuzzer.dictwalker import Mutation, apply_mutation
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+try:
+    text_types = (str, unicode)
+except NameError:  # Python 3
+    text_types = (str,)
+
+
+class BudgetExhausted(Exception):
+    """The minimiser has sent as many requests as it may"""
+    pass
+
+
+class FindingMinimizer(object):
+    """Minimise the injection of one flagged response"""
+
+    # How long to keep minimising one finding, in seconds
+    max_seconds = 300
+
+    def __init__(self, context, response, max_requests=100):
+        """
+        :param context: The Behave context
+        :param response: The flagged response dict, with the verdict and
+        the mutation of the injection case
+        :param max_requests: How many requests may be sent
+        """
+        self.context = context
+        self.verdict = set(response['verdict'])
+        self.method = response['req_method']
+        self.mutation = response['mutation']
+        self.max_requests = max_requests
+        self.requests = 0
+        self.deadline = time.time() + self.max_seconds
+        self.results = {}  # Serialised submission -> still fails
+
+    def minimize(self):
+        """Minimise the injection
+
+        :return: The serialised minimised submission, or None if the
+        finding did not reproduce
+        """
+        document = self.context.submission[0]
+        value = self.mutation.value
+        try:
+            if not self.fails(document, value):
+                return None
+            if isinstance(value, text_types) and len(value) > 1:
+                if self.fails(document, value[:0]):
+                    value = value[:0]
+                else:
+                    value = value[:0].join(ddmin(
+                        list(value),
+                        lambda chars: self.fails(document,
+                                                 value[:0].join(chars))))
+            removable = removable_items(document, self.mutation.path)
+            if removable and self.fails(remove_items(document, removable),
+                                        value):
+                document = remove_items(document, removable)
+            elif removable:
+                kept = ddmin(removable, lambda subset: self.fails(
+                    remove_items(document, [item for item in removable
+                                            if item not in subset]), value))
+                document = remove_items(document, [item for item in removable
+                                                   if item not in kept])
+        except BudgetExhausted:
+            pass  # Use the smallest failing case found so far
+        return self.serialise(document, value)
+
+    def serialise(self, document, value):
+        """:return: The submission with the injected value, serialised"""
+        mutated = apply_mutation(document,
+                                 Mutation(self.mutation.path, value,
+                                          self.mutation.rename))
+        return serialise_submission(self.context, mutated, self.method)
+
+    def fails(self, document, value):
+        """Send a candidate and check it against the detectors
+
+        :return: True if it fails at least one of the checks that the
+        original injection failed
+        """
+        form_string = self.serialise(document, value)
+        if form_string in self.results:
+            return self.results[form_string]
+        if self.requests >= self.max_requests or time.time() > self.deadline:
+            raise BudgetExhausted()
+        self.requests += 1
+        context = self.context
+        template = request_template(context, context.content_type,
+                                    getattr(context, 'proxy_address', None))
+        # Paced and checked for authentication failures like an injection
+        auth, done = start_request(context)
+        sent = False
+        try:
+            req = template.prepare(self.method, form_string, auth)
+            response = new_response(req, form_string, context.targeturi,
+                                    self.method, context.scenario_id)
+            RequestsTransport(context).send(req, response, context.timeout,
+                                            template.proxy)
+            sent = True
+        finally:
+            done(response if sent else None)
+        verdict = context.response_classifier.classify(response)
+        result = len(self.verdict.intersection(verdict)) > 0
+        self.results[form_string] = result
+        return result
+
+
+def ddmin(items, test):
+    """Delta debugging: find a small subset of items for which a test
+    still succeeds. Removes chunks of items, and makes the chunks smaller
+    when none can be removed.
+
+    :param items: List of items for which test(items) is True
+    :param test: Function that takes a list of items
+    :return: A list of items for which test() is True; no single item
+    can be removed from it
+    """
+    granularity = 2
+    while len(items) >= 2:
+        chunk_size = -(-len(items) // granularity)  # Rounded up
+        chunks = [items[i:i + chunk_size]
+                  for i in range(0, len(items), chunk_size)]
+        reduced = False
+        for chunk in chunks:
+            if test(chunk):
+                items, granularity, reduced = chunk, 2, True
+                break
+        if not reduced:
+            for i in range(len(chunks)):
+                complement = [item for chunk in chunks[:i] + chunks[i + 1:]
+                              for item in chunk]
+                if test(complement):
+                    items = complement
+                    granularity = max(granularity - 1, 2)
+                    reduced = True
+                    break
+        if not reduced:
+            if granularity >= len(items):
+                break
+            granularity = min(len(items), granularity * 2)
+    return items
+
+
+def removable_items(document, path):
+    """List the dict entries of a submission that are not on the path to
+    the injected value
+
+    :param document: The submission
+    :param path: Path of the injected value, see dictwalker.py
+    :return: A list of (path to a dict, key) tuples
+    """
+    items = []
+    branch = document
+    for depth, step in enumerate(path):
+        if isinstance(branch, dict):
+            items.extend((path[:depth], key) for key in branch.keys()
+                         if key != step)
+        branch = branch[step]
+    return items
+
+
+def remove_items(document, items):
+    """Return a copy of a submission without some of its dict entries
+
+    :param document: The submission
+    :param items: (path to a dict, key) tuples from removable_items()
+    """
+    document = copy.deepcopy(document)
+    for path, key in items:
+        branch = document
+        for step in path:
+            branch = branch[step]
+        del branch[key]
+    return document
@@ -0,0 +1,183 @@
+"""A built-in fuzzer for the valid values of a submission, for use
+instead of Radamsa. It mutates each value according to its JSON type:
+
+- integers are replaced with boundary values of common integer types,
+  or values next to the original
+- floats are replaced with special values (NaN, infinities, denormals)
+- strings are made oversized, have broken encodings, control
+  characters or format strings inserted, or are truncated
+- any value may be replaced with a value of another type
+
+The mutations are generated on demand in this process, so no temporary
+files or subprocesses are needed. With a seed, the same valid values
+always produce the same fuzz cases.
+
+"""
+import random
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+try:
+    text_types = (str, unicode)
+    integer_types = (int, long)
+except NameError:  # Python 3
+    text_types = (str,)
+    integer_types = (int,)
+
+# Boundaries of signed and unsigned integers of common sizes, and of
+# integers that a double can represent exactly
+INTEGER_BOUNDARIES = [
+    0, 1, -1, 127, 128, -128, -129, 255, 256, 32767, 32768, -32768, -32769,
+    65535, 65536, 2 ** 31 - 1, 2 ** 31, -2 ** 31, -2 ** 31 - 1, 2 ** 32 - 1,
+    2 ** 32, 2 ** 53, 2 ** 53 + 1, 2 ** 63 - 1, 2 ** 63, -2 ** 63,
+    -2 ** 63 - 1, 2 ** 64 - 1, 2 ** 64, 10 ** 100]
+
+FLOAT_SPECIALS = [
+    float('nan'), float('inf'), float('-inf'), -0.0, 5e-324,
+    2.2250738585072014e-308, 1.7976931348623157e308, -1.7976931348623157e308,
+    1e-310, 0.30000000000000004, 9007199254740993.0]
+
+# Byte sequences that break or abuse character encodings
+ENCODING_BREAKAGE = [
+    b'\x00',  # NUL
+    b'\xff\xfe',  # UTF-16 byte order mark, invalid in UTF-8
+    b'\xef\xbb\xbf',  # UTF-8 byte order mark
+    b'\xc0\xaf',  # Overlong encoding of "/"
+    b'\xc0\x80',  # Overlong encoding of NUL
+    b'\xed\xa0\x80',  # Encoded UTF-16 surrogate
+    b'\xf4\x90\x80\x80',  # Beyond U+10FFFF
+    b'\xc3',  # Truncated two-byte sequence
+    b'\x80',  # Lone continuation byte
+    b'\xe2\x80\xae',  # Right-to-left override
+    b'\xf0\x9f\x92\xa9',  # Four-byte character
+    b'%00', b'%c0%af', b'%ff',  # URL-encoded breakage
+    b'\\u0000', b'\\ud800',  # JSON-escaped breakage
+]
+
+# Other strings that often trip up parsers and formatters
+SPECIAL_STRINGS = [
+    b'%s%s%s%s%n', b'%x%x%x%x', b'{0}{1}', b'${7*7}', b'{{7*7}}', b'\r\n',
+    b'\n', b'"', b"'", b'\\', b'<', b'>', b'&', b';', b'|', b'`',
+    b'../../../../', b'*', b'?', b'-1', b'0', b'NaN', b'null', b'undefined',
+    b'true', b'[]', b'{}']
+
+# Lengths for oversized strings
+OVERSIZED_LENGTHS = [256, 1025, 4097, 65537, 1048577]
+
+
+class Mutator(object):
+    """Type-aware mutations of JSON values"""
+
+    def __init__(self, seed=None):
+        """
+        :param seed: Random seed, or None for a random run
+        """
+        self.random = random.Random(seed)
+
+    def mutate(self, value):
+        """Return a mutated version of a value
+
+        :param value: A valid value
+        :return: A fuzz case
+        """
+        if self.random.random() < 0.1:
+            return self.confuse_type(value)
+        if isinstance(value, bool):
+            return self.confuse_type(value)
+        if isinstance(value, integer_types):
+            return self.mutate_integer(value)
+        if isinstance(value, float):
+            return self.random.choice(FLOAT_SPECIALS)
+        if isinstance(value, text_types):
+            return self.mutate_string(value)
+        return self.confuse_type(value)
+
+    def mutate_integer(self, value):
+        """:return: A boundary value, or a value next to the original"""
+        if self.random.random() < 0.25:
+            return value + self.random.choice([-1, 1])
+        return self.random.choice(INTEGER_BOUNDARIES)
+
+    def mutate_string(self, value):
+        """Mutate a string as UTF-8 bytes, so that the encoding can be
+        broken
+
+        :return: The mutated string as a native string, like the fuzz
+        cases that are read from Radamsa's output
+        """
+        value = to_bytes(value)
+        choice = self.random.randint(0, 5)
+        if choice == 0:  # Oversized
+            length = self.random.choice(OVERSIZED_LENGTHS)
+            if value == b'':
+                value = b'A'
+            return to_native((value * (length // len(value) + 1))[:length])
+        if choice == 1:  # Broken encoding
+            return to_native(self.insert(
+                value, self.random.choice(ENCODING_BREAKAGE)))
+        if choice == 2:  # Special characters and format strings
+            return to_native(self.insert(
+                value, self.random.choice(SPECIAL_STRINGS)))
+        if choice == 3:  # Special string in place of the value
+            return to_native(
+                self.random.choice(SPECIAL_STRINGS + ENCODING_BREAKAGE))
+        if choice == 4 and len(value) > 0:  # Truncated
+            return to_native(value[:self.random.randint(0, len(value) - 1)])
+        # A part of the string repeated
+        if len(value) == 0:
+            return to_native(self.random.choice(ENCODING_BREAKAGE))
+        start = self.random.randint(0, len(value) - 1)
+        end = self.random.randint(start + 1, len(value))
+        repeats = self.random.randint(2, 1000)
+        return to_native(value[:end] + value[start:end] * repeats +
+                         value[end:])
+
+    def insert(self, value, insertion):
+        """:return: The value with bytes inserted at a random position"""
+        position = self.random.randint(0, len(value))
+        return value[:position] + insertion + value[position:]
+
+    def confuse_type(self, value):
+        """:return: A value of a different type than the original"""
+        candidates = [None, True, False, 0, -1, 1.5, '', 'true', [], {},
+                      [value], {'': value}]
+        if not isinstance(value, text_types):
+            candidates.append(str(value))
+        return self.random.choice(candidates)
+
+
+def to_bytes(value):
+    """:return: A string as bytes; text is encoded as UTF-8"""
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def to_native(data):
+    """:return: Bytes as a native string. On Python 2 this is the bytes
+    themselves; on Python 3 each byte becomes the code point of the same
+    value.
+    """
+    if str is bytes:
+        return data
+    return data.decode('iso-8859-1')
+
+
+def iter_mutated_values(valuedict, no_of_fuzzcases, seed=None):
+    """Mutate the valid values of every key, and yield the fuzz cases one
+    by one as dicts with a fuzz case for each key (see dictwalker.py).
+    This is the built-in counterpart of iter_fuzz_values() in fuzzer.py.
+
+    :param valuedict: Dict of collected valid values, see fuzzer.py
+    :param no_of_fuzzcases: How many injection cases to produce
+    :param seed: Random seed, or None for a random run
+    """
+    mutator = Mutator(seed)
+    keys = list(valuedict.keys())
+    for _ in range(int(no_of_fuzzcases)):
+        fuzzcase = {}
+        for key in keys:
+            # If no values for a key, use the samples under the None key
+            samples = valuedict[key] or valuedict.get(None) or [None]
+            fuzzcase[key] = mutator.mutate(mutator.random.choice(samples))
+        yield fuzzcase
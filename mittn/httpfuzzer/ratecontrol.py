@@ -0,0 +1,121 @@
+"""Adaptive rate control for injection traffic.
+
+The controller paces the injection requests and adapts the rate with
+additive increase, multiplicative decrease (AIMD), like TCP congestion
+control. While the responses come back about as fast as the valid case
+did in the beginning of the scenario, the rate creeps up. When the
+target shows signs of overload - timeouts, protocol errors (such as
+dropped connections), or 429 and 503 responses - the rate is cut.
+
+The number of requests in flight is limited to what the current rate
+needs to keep the target busy at the baseline latency, so the
+controller also adapts the concurrency within the configured maximum.
+
+"""
+import threading
+import time
+import math
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+# Status codes with which servers ask clients to slow down
+OVERLOAD_STATUS_CODES = [429, 503]
+
+
+class AdaptiveRateController(object):
+    """Pace requests and adapt their rate to the target's responses.
+    Safe to use from several sender threads.
+    """
+
+    def __init__(self, initial_rate, baseline_latency=None,
+                 max_concurrency=1, min_rate=0.5, increase=1.0,
+                 decrease_factor=0.5, latency_tolerance=3.0):
+        """
+        :param initial_rate: Requests per second to start with
+        :param baseline_latency: Normal response time of the target in
+        seconds, or None if not known
+        :param max_concurrency: Maximum number of requests in flight
+        :param min_rate: The rate is never cut below this
+        :param increase: How many requests per second the rate grows
+        in a second of trouble-free sending
+        :param decrease_factor: Multiplier for the rate on overload
+        :param latency_tolerance: Responses slower than this many times the
+        baseline latency do not increase the rate
+        """
+        self.rate = float(initial_rate)
+        self.baseline_latency = baseline_latency
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.lock = threading.Condition()
+        self.next_send = time.time()
+        self.in_flight = 0
+        self.last_decrease = 0.0  # When the rate was cut the last time
+        self.decreases = 0
+
+    def concurrency_limit(self):
+        """:return: How many requests may be in flight at the current rate"""
+        if self.baseline_latency is None:
+            return self.max_concurrency
+        # Little's law: requests in flight = rate * time in flight,
+        # with some slack for latency variation
+        needed = int(math.ceil(self.rate * self.baseline_latency * 2))
+        return max(1, min(self.max_concurrency, needed))
+
+    def acquire(self):
+        """Wait until the next request may be sent
+
+        :return: The time when the request was allowed to go
+        """
+        with self.lock:
+            while self.in_flight >= self.concurrency_limit():
+                self.lock.wait(1)
+            self.in_flight += 1
+            now = time.time()
+            send_at = max(now, self.next_send)
+            self.next_send = send_at + 1.0 / self.rate
+        if send_at > now:
+            time.sleep(send_at - now)
+        return send_at
+
+    def record(self, response, sent_at=None):
+        """Adapt the rate to the outcome of a request that was started
+        with acquire()
+
+        :param response: The response dict, see httptools.py
+        :param sent_at: When the request was sent, as returned by
+        acquire(); overload signals from requests sent before the last
+        cut are ignored, as they do not reflect the new rate
+        """
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            if overloaded(response):
+                if sent_at is None or sent_at >= self.last_decrease:
+                    self.rate = max(self.min_rate,
+                                    self.rate * self.decrease_factor)
+                    self.last_decrease = time.time()
+                    self.decreases += 1
+            elif self.baseline_latency is None or \
+                    response.get('elapsed') is None or \
+                    response['elapsed'] <= \
+                    self.baseline_latency * self.latency_tolerance:
+                # Grow by "increase" requests per second, per second
+                self.rate += self.increase / self.rate
+            self.lock.notify_all()
+
+    def release(self):
+        """Free the slot of a request that was started with acquire() but
+        could not be sent, without adapting the rate
+        """
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.lock.notify_all()
+
+
+def overloaded(response):
+    """:return: True if a response shows that the target is overloaded"""
+    return response.get('server_timeout') is True or \
+        response.get('server_protocol_error') is not None or \
+        response.get('resp_statuscode') in OVERLOAD_STATUS_CODES
@@ -0,0 +1,137 @@
+"""Re-send the findings stored in the database, to check whether they
+still reproduce after a fix.
+
+Each finding is sent again with its stored method, URL, headers and
+body, with fresh authentication. The finding reproduces if the target
+responds in the same way as when the finding was stored: with the same
+status code, timeout and protocol error status, and with the same
+error string in the body if one was found. This is the same comparison
+that is used for recognising known findings (see dbtools.py). The
+result is stored with the finding.
+
+"""
+import json
+from multiprocessing.pool import ThreadPool
+from mittn.httpfuzzer.httptools import new_response, get_transport, \
+    close_transport, request_headers
+from mittn.httpfuzzer.injector import get_auth, ordered_map
+from mittn.httpfuzzer.matcher import MultiPatternMatcher
+import mittn.httpfuzzer.dbtools as fuzzdb
+import requests
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+# Stored headers that are not replayed; authentication is acquired anew
+# and the length is computed from the body
+STALE_HEADERS = ['authorization', 'cookie', 'content-length']
+
+
+def replay_findings(context, scenario_id=None):
+    """Replay stored findings and record whether they still reproduce
+
+    :param context: The Behave context
+    :param scenario_id: Only replay the findings of this scenario, or
+    None for all
+    :return: A list of (finding, response, True if it reproduced) tuples
+    """
+    findings = fuzzdb.stored_findings(context, scenario_id)
+    concurrency = getattr(context, 'concurrency', 1)
+    pool = None
+    if concurrency > 1 and not get_transport(context).asynchronous:
+        pool = ThreadPool(concurrency)
+
+        def submit(finding):
+            return pool.apply_async(send_finding, (context, finding))
+    else:
+        def submit(finding):
+            return submit_finding(context, finding)
+    results = []
+    try:
+        for finding, response_list in ordered_map(submit, findings,
+                                                  max(concurrency, 1) * 2):
+            response = response_list[0]
+            reproduced = reproduces(finding, response)
+            fuzzdb.mark_replayed(context, finding.issue_no,
+                                 'reproduces' if reproduced else 'fixed')
+            results.append((finding, response, reproduced))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        close_transport(context)
+    return results
+
+
+def send_finding(context, finding):
+    """Send a stored finding and wait for the response
+
+    :param context: The Behave context
+    :param finding: A database row, see dbtools.py
+    :return: A list with the response dict, see httptools.py
+    """
+    return submit_finding(context, finding).get()
+
+
+def submit_finding(context, finding):
+    """Start sending a stored finding
+
+    :param context: The Behave context
+    :param finding: A database row, see dbtools.py
+    :return: A pending response, see httptools.py
+    """
+    body = to_text(finding.req_body)
+    try:
+        headers = json.loads(to_text(finding.req_headers))
+    except ValueError:  # Stored by an older version; use the defaults
+        headers = request_headers(
+            getattr(context, 'content_type', 'application/octet-stream'))
+    for name in list(headers.keys()):
+        if name.lower() in STALE_HEADERS:
+            del headers[name]
+    url = str(finding.url)
+    data = body
+    if finding.req_method == 'GET':  # The submission was in the URI
+        url += body
+        data = None
+    req = requests.Request(method=finding.req_method, url=url,
+                           headers=headers, data=data,
+                           auth=get_auth(context)).prepare()
+    response = new_response(req, body, finding.url, finding.req_method,
+                            finding.scenario_id)
+    return get_transport(context).submit(
+        req, response, getattr(context, 'timeout', 5),
+        getattr(context, 'proxy_address', None))
+
+
+def reproduces(finding, response):
+    """Compare a replayed response to the stored finding
+
+    :param finding: A database row, see dbtools.py
+    :param response: The response dict of the replay
+    :return: True if the target responded like it did originally
+    """
+    if bool(finding.server_timeout) != response['server_timeout']:
+        return False
+    if (finding.server_protocol_error is not None) != \
+            (response['server_protocol_error'] is not None):
+        return False
+    if str(finding.resp_statuscode) != str(response['resp_statuscode']):
+        return False
+    if finding.server_error_text_detected and \
+            finding.server_error_text_matched:
+        matcher = MultiPatternMatcher([finding.server_error_text_matched])
+        if matcher.search(response['resp_body']) is None:
+            return False
+    return True
+
+
+def to_text(value):
+    """Return a stored binary column value as a string"""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    value = bytes(value)  # Python 2 buffer, or Python 3 bytes
+    if not isinstance(value, str):
+        value = value.decode('iso-8859-1')
+    return value
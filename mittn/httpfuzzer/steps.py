@@ -2,14 +2,19 @@
 from behave import *
 from mittn.httpfuzzer.static_anomalies import *
 from mittn.httpfuzzer.fuzzer import *
+from mittn.httpfuzzer.mutator import iter_mutated_values
 from mittn.httpfuzzer.injector import *
+from mittn.httpfuzzer.detectors import *
+from mittn.httpfuzzer.authcache import AuthCache
+from mittn.httpfuzzer.replay import replay_findings
+from mittn.httpfuzzer.checkpoint import InjectionJournal, scenario_fingerprint
 from mittn.httpfuzzer.number_ranges import *
 from mittn.httpfuzzer.url_params import *
 import mittn.httpfuzzer.dbtools as fuzzdb
 import json
 import urlparse2
 import subprocess
-import re
+import random
 
 __copyright__ = "Copyright (c) 2013- F-Secure"
 
@@ -41,6 +46,21 @@ def step_impl(context, auth_id):
     assert True
 
 
+@given(u'authentication material cached for "{ttl}" seconds')
+def step_impl(context, ttl):
+    """Reuse the auth material from authenticate.py for the given time,
+    or until the target rejects it, see authcache.py.
+    """
+    try:
+        ttl = float(ttl)
+    except ValueError:
+        assert False, "Invalid cache time %s" % ttl
+    if ttl <= 0:
+        assert False, "Invalid cache time %s" % ttl
+    context.auth_cache = AuthCache(authenticate, ttl)
+    assert True
+
+
 @given(u'valid case instrumentation with success defined as "{valid_cases}"')
 def step_impl(context, valid_cases):
     """Make a note of the fact that we would like to do valid case
@@ -51,6 +71,49 @@ def step_impl(context, valid_cases):
     assert True
 
 
+@given(u'valid case instrumentation every "{number}" injections')
+def step_impl(context, number):
+    """Try the valid case after every N injections instead of after each
+    one."""
+
+    try:
+        context.valid_case_every_requests = int(number)
+    except ValueError:
+        assert False, "Invalid number of injections %s" % number
+    if context.valid_case_every_requests < 1:
+        assert False, "Invalid number of injections %s" % number
+    assert True
+
+
+@given(u'valid case instrumentation every "{seconds}" seconds')
+def step_impl(context, seconds):
+    """Try the valid case when the given time has passed since the last
+    try, instead of after each injection."""
+
+    try:
+        context.valid_case_every_seconds = float(seconds)
+    except ValueError:
+        assert False, "Invalid valid case interval %s" % seconds
+    if not context.valid_case_every_seconds > 0:  # Also rejects NaN
+        assert False, "Invalid valid case interval %s" % seconds
+    assert True
+
+
+@given(u'valid case instrumentation in the background every "{seconds}" seconds')
+def step_impl(context, seconds):
+    """Try the valid case periodically alongside the injections instead of
+    after each injection."""
+
+    try:
+        context.valid_case_every_seconds = float(seconds)
+    except ValueError:
+        assert False, "Invalid valid case interval %s" % seconds
+    if not context.valid_case_every_seconds > 0:  # Also rejects NaN
+        assert False, "Invalid valid case interval %s" % seconds
+    context.valid_case_background = True
+    assert True
+
+
 @given(u'a web proxy')
 def step_impl(context):
     """Check that we have a proxy defined in the environment file.
@@ -72,6 +135,144 @@ def step_impl(context, timeout):
     assert True
 
 
+@given(u'at most "{concurrency}" concurrent requests to the target')
+def step_impl(context, concurrency):
+    """Store the number of injection requests that may be in flight
+    towards the target at the same time.
+    """
+    try:
+        context.concurrency = int(concurrency)
+    except ValueError:
+        assert False, "Invalid concurrency value %s" % concurrency
+    if context.concurrency < 1:
+        assert False, "Invalid concurrency value %s" % context.concurrency
+    assert True
+
+
+@given(u'requests sent using the "{transport}" HTTP transport')
+def step_impl(context, transport):
+    """Select the HTTP transport used for sending injections, see
+    httptools.py.
+    """
+    if transport not in TRANSPORTS:
+        assert False, "Unknown HTTP transport %s, must be one of %s" % (
+            transport, ", ".join(sorted(TRANSPORTS.keys())))
+    context.http_transport = transport
+    assert True
+
+
+@given(u'persistent connections to the target')
+def step_impl(context):
+    """Keep connections to the target open and reuse them for the whole
+    scenario, instead of connecting anew for each request.
+    """
+    context.persistent_connections = True
+    assert True
+
+
+@given(u'identical injections sent only once')
+def step_impl(context):
+    """Skip injection cases that would send the same request (the same
+    method and body) as a recent case, see DuplicateFilter in injector.py.
+    """
+    context.skip_duplicate_injections = True
+    assert True
+
+
+@given(u'streaming response analysis')
+def step_impl(context):
+    """Analyse the responses as they come in instead of collecting all
+    of them first. Only the flagged responses are kept in memory.
+    """
+    context.streaming_analysis = True
+    assert True
+
+
+@given(u'response bodies scanned for error strings up to "{size}" bytes')
+def step_impl(context, size):
+    """Store how much of each response body is searched for error strings.
+    """
+    try:
+        context.error_text_scan_limit = int(size)
+    except ValueError:
+        assert False, "Invalid body size %s" % size
+    if context.error_text_scan_limit < 0:
+        assert False, "Invalid body size %s" % context.error_text_scan_limit
+    assert True
+
+
+@given(u'adaptive rate control starting at "{rate}" requests per second')
+def step_impl(context, rate):
+    """Pace the injections, and adapt the rate to how the target copes,
+    see ratecontrol.py.
+    """
+    try:
+        context.adaptive_rate = float(rate)
+    except ValueError:
+        assert False, "Invalid request rate %s" % rate
+    if context.adaptive_rate <= 0:
+        assert False, "Invalid request rate %s" % context.adaptive_rate
+    assert True
+
+
+@given(u'progress checkpointed in directory "{directory}"')
+def step_impl(context, directory):
+    """Record the progress of the injection run, so that an interrupted
+    run can be resumed, see checkpoint.py. The progress is recorded as
+    the responses are analysed, so this implies streaming analysis.
+    """
+    context.checkpoint_directory = directory
+    context.streaming_analysis = True
+    assert True
+
+
+@given(u'findings stored in batches of "{size}" or every "{seconds}" seconds')
+def step_impl(context, size, seconds):
+    """Write new findings into the database in batches, each in one
+    transaction. The batch is written when it is full, when its oldest
+    finding has waited for the given time, and at the end of the scenario.
+    """
+    try:
+        context.finding_batch_size = int(size)
+    except ValueError:
+        assert False, "Invalid finding batch size %s" % size
+    if context.finding_batch_size < 1:
+        assert False, "Invalid finding batch size %s" % size
+    try:
+        context.finding_batch_seconds = float(seconds)
+    except ValueError:
+        assert False, "Invalid finding batch interval %s" % seconds
+    if not context.finding_batch_seconds > 0:  # Also rejects NaN
+        assert False, "Invalid finding batch interval %s" % seconds
+    assert True
+
+
+@given(u'findings written in the background')
+def step_impl(context):
+    """Hand new findings over to a writer thread that has its own
+    database connection, so that analysing the responses does not wait
+    for the database. The findings are written in the batches set with
+    the step above. The writer is flushed before the findings are counted.
+    """
+    context.background_finding_writes = True
+    assert True
+
+
+@given(u'findings minimized with at most "{requests}" requests each')
+def step_impl(context, requests):
+    """Shrink the injection of each new finding before storing it, see
+    minimizer.py. Minimising sends more requests to the target.
+    """
+    try:
+        context.minimize_findings = int(requests)
+    except ValueError:
+        assert False, "Invalid number of minimisation requests %s" % requests
+    if context.minimize_findings < 1:
+        assert False, "Invalid number of minimisation requests %s" % \
+                      context.minimize_findings
+    assert True
+
+
 @given(u'A working Radamsa installation')
 def step_impl(context):
     """Check for a working Radamsa installation."""
@@ -87,6 +288,15 @@ def step_impl(context):
     assert True
 
 
+@given(u'fuzz cases generated with the built-in mutator')
+def step_impl(context):
+    """Generate the fuzz cases with the built-in mutator (mutator.py)
+    instead of Radamsa. Radamsa does not need to be installed.
+    """
+    context.builtin_mutator = True
+    assert True
+
+
 @given(u'target URL "{uri}"')
 def step_impl(context, uri):
     """Store the target URI that we are injecting or fuzzing."""
@@ -149,85 +359,55 @@ def step_impl(context):
     """
     context.new_findings = 0
     # Create the list of static injections using a helper generator
+    open_journal(context, 'static')
     injection_list = anomaly_dict_generator_static(anomaly_list)
-    context.responses = inject(context, injection_list)
+    start_injection(context, injection_list)
     assert True
 
 
 @when(u'storing any new cases of return codes "{returncode_list}"')
 def step_impl(context, returncode_list):
-    """Go through responses and store any with suspect return codes
-    into the database
+    """Store any responses with suspect return codes into the database
     """
 
     disallowed_returncodes = unpack_integer_range(returncode_list)
-    new_findings = 0
-    for response in context.responses:
-        if response['resp_statuscode'] in disallowed_returncodes:
-            if fuzzdb.known_false_positive(context, response) is False:
-                fuzzdb.add_false_positive(context, response)
-                new_findings += 1
-    if new_findings > 0:
-        context.new_findings += new_findings
+    add_detector(context, 'return code',
+                 returncode_detector(disallowed_returncodes))
     assert True
 
 
 @when(u'storing any new cases of responses timing out')
 def step_impl(context):
-    """Go through responses and save any that timed out into the database
+    """Store any responses that timed out into the database
     """
 
-    new_findings = 0
-    for response in context.responses:
-        if response.get('server_timeout') is True:
-            if fuzzdb.known_false_positive(context, response) is False:
-                fuzzdb.add_false_positive(context, response)
-                new_findings += 1
-    if new_findings > 0:
-        context.new_findings += new_findings
+    add_detector(context, 'timeout', timeout_detector())
     assert True
 
 
 @when(u'storing any new invalid server responses')
 def step_impl(context):
-    """Go through responses and store any with HTTP protocol errors
-    (as caught by Requests) into the database
+    """Store any responses with HTTP protocol errors (as caught by
+    Requests) into the database
     """
 
-    new_findings = 0
-    for response in context.responses:
-        if response.get('server_protocol_error') is not None:
-            if fuzzdb.known_false_positive(context, response) is False:
-                fuzzdb.add_false_positive(context, response)
-                new_findings += 1
-    if new_findings > 0:
-        context.new_findings += new_findings
+    add_detector(context, 'protocol error', protocol_error_detector())
     assert True
 
 
 @when(u'storing any new cases of response bodies that contain strings')
 def step_impl(context):
-    """Go through responses and store any that contain a string from
-    user-supplied list of strings into the database
+    """Store any responses that contain a string from user-supplied list
+    of strings into the database
     """
 
-    # Create a regex from the error response list
     error_list = []
     for row in context.table:
         error_list.append(row['string'])
-    error_list_regex = "(" + ")|(".join(error_list) + ")"
-
-    # For each response, check that it isn't in the error response list
-    new_findings = 0
-    for response in context.responses:
-        if re.search(error_list_regex, response.get('resp_body'),
-                     re.IGNORECASE) is not None:
-            response['server_error_text_detected'] = True
-            if fuzzdb.known_false_positive(context, response) is False:
-                fuzzdb.add_false_positive(context, response)
-                new_findings += 1
-    if new_findings > 0:
-        context.new_findings += new_findings
+    add_detector(context, 'error text',
+                 body_string_detector(error_list,
+                                      getattr(context, 'error_text_scan_limit',
+                                              None)))
     assert True
 
 
@@ -325,11 +505,54 @@ def step_impl(context, no_of_cases):
     valuelist = {}
     for submission in context.submission:
         valuelist = collect_values(submission, valuelist)
-    # Create the list of fuzz injections using a helper generator
-    fuzzed_anomalies_dict = fuzz_values(valuelist, no_of_cases,
-                                        context.radamsa_location)
-    injection_list = anomaly_dict_generator_fuzz(fuzzed_anomalies_dict)
-    context.responses = inject(context, injection_list)
+    # Generate the fuzz injections a chunk at a time while injecting. A
+    # resumed run generates the same fuzz cases as the interrupted one,
+    # so an unseeded run is given a random seed that the journal keeps.
+    seed = fuzz_seed(context)
+    journal = open_journal(context, 'fuzz', no_of_cases, seed,
+                           getattr(context, 'builtin_mutator', False))
+    if journal is not None and seed is None:
+        seed = journal.load_seed()
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+            journal.save_seed(seed)
+    if getattr(context, 'builtin_mutator', False) is True:
+        injection_list = iter_mutated_values(valuelist, no_of_cases, seed)
+    else:
+        injection_list = iter_fuzz_values(valuelist, no_of_cases,
+                                          context.radamsa_location, seed,
+                                          cache=fuzz_cache(context))
+    start_injection(context, injection_list)
+    assert True
+
+
+@when(u'replaying the stored findings')
+def step_impl(context):
+    """Re-send the findings stored in the database for this scenario (or
+    all findings, if no scenario id has been given), and record whether
+    they still reproduce
+    """
+    if hasattr(context, 'dburl') is False:
+        assert False, "Database URI not specified"
+    context.replay_results = replay_findings(
+        context, getattr(context, 'scenario_id', None))
+    assert True
+
+
+@then(u'no replayed findings reproduced')
+def step_impl(context):
+    """Check that none of the replayed findings reproduced
+    """
+    if getattr(context, 'replay_results', None) is None:
+        assert False, "The findings have not been replayed; use the " \
+                      "\"replaying the stored findings\" step first"
+    reproduced = [str(finding.issue_no) for finding, response, result
+                  in context.replay_results if result is True]
+    if len(reproduced) > 0:
+        assert False, "%s of %s replayed findings still reproduce: issue " \
+                      "numbers %s" % (len(reproduced),
+                                      len(context.replay_results),
+                                      ", ".join(reproduced))
     assert True
 
 
@@ -346,6 +569,7 @@ def step_impl(context, methods):
 def step_impl(context):
     """Check whether we stored any new findings
     """
+    analyse_responses(context)
     if context.new_findings > 0:
         assert False, "%s new findings were found." % context.new_findings
     old_findings = fuzzdb.number_of_new_in_database(context)
@@ -353,3 +577,82 @@ def step_impl(context):
         assert False, "No new findings found, but %s unprocessed findings " \
                       "from past runs found in database." % old_findings
     assert True
+
+
+def start_injection(context, injection_list):
+    """Start injecting. Without streaming analysis, all the responses
+    are collected into context.responses first. With streaming analysis,
+    the injection is only set up here, and the requests are sent one at
+    a time while the responses are analysed. Either way, the detector
+    steps that follow only configure the classifier, and the responses
+    are analysed in one pass by analyse_responses().
+
+    :param context: The Behave context
+    :param injection_list: An anomaly dictionary, see dictwalker.py
+    """
+    context.response_classifier = ResponseClassifier()
+    fuzzdb.load_known_findings(context)
+    if getattr(context, 'streaming_analysis', False) is True:
+        context.responses = []  # Will only hold the flagged responses
+        context.unanalysed_responses = iter_inject(context, injection_list)
+    else:
+        context.responses = inject(context, injection_list)
+        context.unanalysed_responses = iter(context.responses)
+
+
+def open_journal(context, *settings):
+    """Open the progress journal of the scenario, if checkpoints are in use
+
+    :param context: The Behave context
+    :param settings: Settings that define the injection space, in
+    addition to the submission, target and methods
+    :return: An InjectionJournal, or None
+    """
+    context.journal = None
+    if getattr(context, 'checkpoint_directory', None) is not None:
+        # Shards of the same scenario may share the directory
+        journal_id = context.scenario_id
+        if shard_of(context) is not None:
+            journal_id = "%s-shard-%s-of-%s" % (
+                (context.scenario_id,) + shard_of(context))
+        context.journal = InjectionJournal(
+            context.checkpoint_directory, journal_id,
+            scenario_fingerprint(context, *settings))
+    return context.journal
+
+
+def fuzz_seed(context):
+    """Return the random seed for Radamsa. The seed can be given on the
+    command line as "behave -D fuzz_seed=N". When the injection space is
+    sharded, every shard has to generate the same fuzz cases, so the seed
+    must then be given.
+
+    :param context: The Behave context
+    :return: An integer seed, or None for a random run
+    """
+    userdata = getattr(getattr(context, 'config', None), 'userdata', {})
+    if userdata.get('fuzz_seed') is not None:
+        try:
+            return int(userdata['fuzz_seed'])
+        except ValueError:
+            assert False, "Fuzz seed must be an integer, not %s" % \
+                          userdata['fuzz_seed']
+    if shard_of(context) is not None:
+        assert False, "Sharded fuzzing needs the same seed for all the " \
+                      "shards; give a new one for each run with " \
+                      "\"-D fuzz_seed=N\""
+    return None
+
+
+def fuzz_cache(context):
+    """Return the cache for Radamsa outputs, if one has been configured in
+    environment.py
+
+    :param context: The Behave context
+    :return: A FuzzCache, or None
+    """
+    directory = getattr(context, 'fuzz_cache_directory', None)
+    if directory is None:
+        return None
+    max_megabytes = getattr(context, 'fuzz_cache_megabytes', 1024)
+    return FuzzCache(directory, max_megabytes * 1024 * 1024)
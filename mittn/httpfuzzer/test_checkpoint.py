@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import shutil
+import os
+from mittn.httpfuzzer.checkpoint import InjectionJournal
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+
+class checkpoint_test_case(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def interrupted_run(self, fingerprint='settings'):
+        journal = InjectionJournal(self.directory, 'scenario 1', fingerprint)
+        journal.record((0, 0, 'POST'))
+        journal.record((0, 1, 'GET'))
+        journal.journal.close()  # Interrupted; not completed
+
+    def test_resume(self):
+        self.interrupted_run()
+        journal = InjectionJournal(self.directory, 'scenario 1', 'settings')
+        self.assertTrue(journal.completed((0, 0, 'POST')),
+                        "A recorded case was not loaded")
+        self.assertTrue(journal.completed((0, 1, 'GET')),
+                        "A recorded case was not loaded")
+        self.assertFalse(journal.completed((1, 0, 'POST')),
+                         "An unrecorded case was marked completed")
+
+    def test_changed_settings_discard_journal(self):
+        self.interrupted_run()
+        journal = InjectionJournal(self.directory, 'scenario 1', 'changed')
+        self.assertFalse(journal.completed((0, 0, 'POST')),
+                         "A journal of other settings was used")
+
+    def test_partial_last_line(self):
+        self.interrupted_run()
+        with open(os.path.join(self.directory, 'scenario_1.journal'),
+                  'a') as journal_file:
+            journal_file.write('[1, 0, "PO')
+        journal = InjectionJournal(self.directory, 'scenario 1', 'settings')
+        self.assertTrue(journal.completed((0, 1, 'GET')),
+                        "Cases before a partial line were not loaded")
+        self.assertFalse(journal.completed((1, 0, 'POST')),
+                         "A partially written case was marked completed")
+
+    def test_seed_round_trip(self):
+        journal = InjectionJournal(self.directory, 'scenario 1', 'settings')
+        self.assertEqual(journal.load_seed(), None,
+                         "A seed was loaded before one was saved")
+        journal.save_seed(12345)
+        journal.journal.close()
+        journal = InjectionJournal(self.directory, 'scenario 1', 'settings')
+        self.assertEqual(journal.load_seed(), 12345,
+                         "The saved seed was not loaded")
+        journal.journal.close()
+        journal = InjectionJournal(self.directory, 'scenario 1', 'changed')
+        self.assertEqual(journal.load_seed(), None,
+                         "A seed of other settings was loaded")
+
+    def test_complete_removes_journal(self):
+        journal = InjectionJournal(self.directory, 'scenario 1', 'settings')
+        journal.record((0, 0, 'POST'))
+        journal.save_seed(1)
+        journal.complete()
+        self.assertEqual(os.listdir(self.directory), [],
+                         "Journal files were left behind")
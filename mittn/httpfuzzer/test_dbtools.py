@@ -37,6 +37,16 @@ class dbtools_test_case(unittest.TestCase):
                          sqlalchemy.engine.base.Connection,
                          "An SQLAlchemy connection object was not returned")
 
+    def test_engine_shared_within_run(self):
+        # Connections to the same database should come from one engine
+        # and its connection pool
+        first = dbtools.open_database(self.context)
+        second = dbtools.open_database(self.context)
+        self.assertIs(first.engine, second.engine,
+                      "A new engine was created for each connection")
+        first.close()
+        second.close()
+
     def test_add_false_positive(self):
         # Add a false positive to database and check that all fields
         # get populated and can be compared back originals
@@ -182,6 +192,26 @@ class dbtools_test_case(unittest.TestCase):
                                                       response),
                          True, "A duplicate case not detected")
 
+    def test_upgrade_old_table(self):
+        # Create the table as an older version did, and check that opening
+        # the database adds the missing columns
+        db_engine = sqlalchemy.create_engine(self.context.dburl)
+        db_metadata = sqlalchemy.MetaData()
+        Table('httpfuzzer_issues', db_metadata,
+              Column('new_issue', types.Boolean),
+              Column('issue_no', types.Integer, primary_key=True, nullable=False),
+              Column('scenario_id', types.Text))
+        db_metadata.create_all(db_engine)
+
+        dbconn = dbtools.open_database(self.context)
+        dbconn.close()
+        columns = [column['name'] for column in
+                   sqlalchemy.inspect(db_engine).get_columns('httpfuzzer_issues')]
+        for column in ['req_body', 'replay_status', 'replay_timestamp',
+                       'finding_signature']:
+            self.assertIn(column, columns,
+                          "Column %s not added to an old table" % column)
+
     def tearDown(self):
         try:
             os.unlink(self.db_file)
@@ -0,0 +1,83 @@
+import unittest
+import copy
+from mittn.httpfuzzer.dictwalker import dictwalk, iter_mutations, \
+    apply_mutation
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+try:
+    text_types = (str, unicode)
+except NameError:  # Python 3
+    text_types = (str,)
+
+
+def reference_dictwalk(branch, anomaly_dict, anomaly_key=None):
+    """dictwalk() as it was before iter_mutations() and apply_mutation().
+    The checkpoint and shard keys depend on the mutations coming in this
+    order.
+    """
+    if isinstance(branch, dict):
+        fuzzed_branch = []
+        for key in branch.keys():
+            fuzzdict = branch.copy()
+            try:
+                fuzzdict[str(anomaly_dict[None])] = fuzzdict[key]
+            except UnicodeEncodeError:
+                fuzzdict['\xff\xff'] = fuzzdict[key]
+            del fuzzdict[key]
+            fuzzed_branch.append(fuzzdict)
+        for key, value in branch.items():
+            for sub_branch in reference_dictwalk(value, anomaly_dict, key):
+                fuzzdict = branch.copy()
+                fuzzdict[key] = sub_branch
+                fuzzed_branch.append(fuzzdict)
+        return fuzzed_branch
+    if isinstance(branch, list):
+        fuzzed_branch = []
+        for i in range(0, len(branch)):
+            for sub_branch in reference_dictwalk(branch[i], anomaly_dict,
+                                                 anomaly_key):
+                fuzzdict = copy.copy(branch)
+                fuzzdict[i] = sub_branch
+                fuzzed_branch.append(fuzzdict)
+        return fuzzed_branch
+    if isinstance(branch, (int, float) + text_types) or \
+            branch in (True, False, None):
+        anomaly = anomaly_dict.get(anomaly_key)
+        if anomaly is None:
+            anomaly = anomaly_dict.get(None)
+        return [anomaly]
+    return [branch]
+
+
+class dictwalker_test_case(unittest.TestCase):
+    def setUp(self):
+        self.document = {'name': 'abc',
+                         'count': 42,
+                         'flags': [True, None, 1.5],
+                         'nested': {'items': [{'id': 1, 'tags': ['x', 'y']},
+                                              {'id': 2, 'tags': []}],
+                                    'empty': {}},
+                         'list_of_lists': [[1, 2], ['a']]}
+        self.anomaly_dict = {None: '<generic>', 'id': '<id>', 'tags': '<tag>'}
+
+    def test_same_mutations_as_reference(self):
+        expected = reference_dictwalk(self.document, self.anomaly_dict)
+        self.assertEqual(dictwalk(self.document, self.anomaly_dict), expected,
+                         "dictwalk() output differs from the reference")
+        mutations = list(iter_mutations(self.document, self.anomaly_dict))
+        self.assertEqual([apply_mutation(self.document, mutation)
+                          for mutation in mutations], expected,
+                         "Mutations differ from the reference or its order")
+        self.assertTrue([mutation for mutation in mutations
+                         if mutation.rename is True],
+                        "No key renaming mutations generated")
+
+    def test_original_not_modified(self):
+        original = copy.deepcopy(self.document)
+        for mutation in iter_mutations(self.document, self.anomaly_dict):
+            mutated = apply_mutation(self.document, mutation)
+            self.assertNotEqual(mutated, self.document,
+                                "A mutation did not change the document")
+            self.assertEqual(self.document, original,
+                             "The original document was modified")
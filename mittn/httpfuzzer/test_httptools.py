@@ -0,0 +1,21 @@
+import unittest
+import requests.auth
+from mittn.httpfuzzer.httptools import RequestTemplate
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+
+class httptools_test_case(unittest.TestCase):
+    def test_template_hooks_not_shared(self):
+        template = RequestTemplate('http://localhost/api', 'application/json')
+        first = template.prepare('POST', '{}',
+                                 requests.auth.HTTPDigestAuth('user', 'pw'))
+        second = template.prepare('POST', '{}',
+                                  requests.auth.HTTPDigestAuth('user', 'pw'))
+        self.assertEqual(template.prepared['POST'].hooks['response'], [],
+                         "Auth hooks were added to the template")
+        self.assertEqual(len(first.hooks['response']),
+                         len(second.hooks['response']),
+                         "Auth hooks accumulated between requests")
+        self.assertTrue(first.hooks['response'],
+                        "The auth hooks were not registered")
@@ -0,0 +1,47 @@
+import unittest
+from mittn.httpfuzzer.matcher import MultiPatternMatcher
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+
+class matcher_test_case(unittest.TestCase):
+    def setUp(self):
+        self.matcher = MultiPatternMatcher(['server error', 'SQL',
+                                            'root:', 'error'])
+
+    def test_no_match(self):
+        self.assertEqual(self.matcher.search(b'<html>All fine</html>'), None,
+                         "A body without the patterns matched")
+        self.assertEqual(self.matcher.search(b''), None,
+                         "An empty body matched")
+
+    def test_match_reports_pattern(self):
+        self.assertEqual(self.matcher.search(b'You have an error in your '
+                                             b'SQL syntax'),
+                         'error', "The first matching pattern not reported")
+        self.assertEqual(self.matcher.search(b'x root:x:0:0'), 'root:',
+                         "Pattern with punctuation not matched")
+
+    def test_case_insensitive(self):
+        self.assertEqual(self.matcher.search(b'PostgreSQL: sql error'),
+                         'SQL', "Matching is not case insensitive")
+        self.assertEqual(self.matcher.search(u'Internal Server Error'),
+                         'server error', "Text bodies are not matched")
+
+    def test_overlapping_patterns(self):
+        # The end of one pattern is the start of another
+        matcher = MultiPatternMatcher(['abcd', 'bce', 'cz'])
+        self.assertEqual(matcher.search(b'xxabczz'), 'cz',
+                         "Pattern inside a failed longer one not matched")
+        self.assertEqual(matcher.search(b'xabcex'), 'bce',
+                         "Pattern after a failed prefix not matched")
+
+    def test_limit(self):
+        body = b'x' * 100 + b'exception'
+        matcher = MultiPatternMatcher(['exception'])
+        self.assertEqual(matcher.search(body, limit=100), None,
+                         "Body scanned beyond the limit")
+        self.assertEqual(matcher.search(body, limit=109), 'exception',
+                         "Pattern ending at the limit not matched")
+        self.assertEqual(matcher.search(body), 'exception',
+                         "Pattern not found without a limit")
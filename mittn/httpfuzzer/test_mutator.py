@@ -0,0 +1,70 @@
+import unittest
+import math
+import json
+from mittn.httpfuzzer.mutator import Mutator, iter_mutated_values, \
+    INTEGER_BOUNDARIES
+
+__copyright__ = "Copyright (c) 2013- F-Secure"
+
+# Python 2 byte strings are serialised like in posttools.py
+JSON_OPTIONS = {'encoding': 'iso-8859-1'} if str is bytes else {}
+
+
+class mutator_test_case(unittest.TestCase):
+    def setUp(self):
+        self.valuedict = {None: ['abc', 42, 1.5, True],
+                          'name': ['abc'], 'count': [42], 'nested': []}
+
+    def test_seeded_runs_repeat(self):
+        first = list(iter_mutated_values(self.valuedict, 50, seed=1))
+        second = list(iter_mutated_values(self.valuedict, 50, seed=1))
+        self.assertEqual(repr(first), repr(second),
+                         "The same seed produced different fuzz cases")
+        other = list(iter_mutated_values(self.valuedict, 50, seed=2))
+        self.assertNotEqual(repr(first), repr(other),
+                            "Different seeds produced the same fuzz cases")
+
+    def test_fuzz_case_for_every_key(self):
+        cases = list(iter_mutated_values(self.valuedict, 10, seed=1))
+        self.assertEqual(len(cases), 10, "Wrong number of fuzz cases")
+        for case in cases:
+            self.assertEqual(set(case.keys()), set(self.valuedict.keys()),
+                             "A fuzz case is missing keys")
+
+    def test_type_aware_mutations(self):
+        mutator = Mutator(seed=1)
+        integers = [mutator.mutate_integer(42) for _ in range(100)]
+        self.assertTrue(set(integers) & set(INTEGER_BOUNDARIES),
+                        "No integer boundaries generated")
+        floats = [mutator.mutate(1.5) for _ in range(100)]
+        self.assertTrue([value for value in floats
+                         if isinstance(value, float) and math.isnan(value)],
+                        "No float specials generated")
+        strings = [mutator.mutate_string('abc') for _ in range(100)]
+        self.assertTrue([value for value in strings if len(value) > 255],
+                        "No oversized strings generated")
+        confused = [mutator.confuse_type(True) for _ in range(100)]
+        self.assertTrue([value for value in confused
+                         if not isinstance(value, bool)],
+                        "No type confusion generated")
+
+    def test_unicode_samples(self):
+        valuedict = {None: [u'\xe4\xe4kk\xf6set', u'abc', u''],
+                     'name': [u'\u20ac'], 'empty': []}
+        for seed in range(10):
+            for case in iter_mutated_values(valuedict, 50, seed=seed):
+                json.dumps(case, **JSON_OPTIONS)  # Must stay serialisable
+        mutator = Mutator(seed=1)
+        strings = [mutator.mutate_string(u'\xe4bc') for _ in range(200)]
+        for value in strings:
+            self.assertTrue(isinstance(value, str),
+                            "A mutated string is not a native string")
+        self.assertTrue([value for value in strings if '\xc0\xaf' in value],
+                        "No broken encodings generated")
+
+    def test_non_string_samples(self):
+        valuedict = {None: [None, [1, 2], {'a': 1}, 0, False, -1.0]}
+        cases = list(iter_mutated_values(valuedict, 200, seed=1))
+        self.assertEqual(len(cases), 200, "Wrong number of fuzz cases")
+        for case in cases:
+            json.dumps(case, **JSON_OPTIONS)